@@ -0,0 +1,490 @@
+'''
+Benchmarks the hot paths of project.py against a local stub server.
+
+The stub server runs in its own process and stands in for the Open Weather
+Map history endpoint, the Open Cage geocoder and the three Wikipedia pages,
+so the benchmarks need no network access and no API keys. The Wikipedia
+pages are generated in the same format as the real ones from the countries
+in air_pollution.csv.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --cities 10,100,1000,10000 --csv-scales 1,10,100 --output results.json
+
+The results are printed as JSON, or written to the --output file, so they
+can be compared between versions.
+'''
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import project
+
+COMPONENT_KEYS = ["co", "no", "no2", "o3", "so2", "pm2_5", "pm10", "nh3"]
+CO2_PAGE = 'List_of_countries_by_carbon_dioxide_emissions'
+COUNTRY_CODES_PAGE = 'ISO_3166-1_alpha-3'
+ALT_COUNTRY_NAMES_PAGE = 'List_of_alternative_country_names'
+
+def city_name(index):
+    '''
+    Returns the name of synthetic city number index.
+
+    Parameters
+    ----------
+    index: int
+        city number
+
+    Returns
+    -------
+    name: string
+        city name
+    '''
+    return f"City {index:05d}, Country"
+
+def city_coordinates(query):
+    '''
+    Returns the coordinates of a synthetic city. Cities are half a degree
+    apart, so no two of them are close enough to share cached data.
+
+    Parameters
+    ----------
+    query: string
+        city name
+
+    Returns
+    -------
+    coordinates: tuple
+        (lat, lon), or None for names that aren't synthetic cities
+    '''
+    match = re.search(r"City (\d+)", query)
+    if match is None:
+        return None
+    index = int(match.group(1))
+    return (-60 + (index // 360) * 0.5, -180 + (index % 360) * 1.0)
+
+def history_response(lat, lon, start, end):
+    '''
+    Builds an Open Weather Map history response with one record per hour.
+
+    Parameters
+    ----------
+    lat, lon: float
+        coordinates
+    start, end: int
+        unix times of the first and last record
+
+    Returns
+    -------
+    response: dict
+        the history response
+    '''
+    rng = random.Random(f"{lat:.4f},{lon:.4f}")
+    base = [rng.uniform(1, 100) for key in COMPONENT_KEYS]
+    records = []
+    first = start + (-start % 3600)
+    for dt in range(first, end + 1, 3600):
+        wave = 1 + 0.5 * math.sin(dt / 43200)
+        records.append({'main': {'aqi': 1 + dt // 3600 % 5},
+                'components': {key: round(value * wave, 2) for key, value in zip(COMPONENT_KEYS, base)},
+                'dt': dt})
+    return {'coord': {'lon': lon, 'lat': lat}, 'list': records}
+
+def make_pages(countries):
+    '''
+    Generates the three Wikipedia pages in the format the scrapers expect.
+
+    Parameters
+    ----------
+    countries: list
+        (name, code) tuples
+
+    Returns
+    -------
+    pages: dict
+        page name -> html
+    '''
+    rng = random.Random(0)
+    co2_rows = ''.join('<tr><th>header</th></tr>' for index in range(5))
+    iso_items = ''
+    alt_rows = '<tr><th>Code</th><th>Name</th><th>Other names</th></tr>'
+    for name, code in countries:
+        co2_rows += (f"<tr><td>{name}</td><td>{rng.uniform(0, 6000):,.1f}</td>"
+                + f"<td>{rng.uniform(0, 6000):,.1f}</td><td>{rng.uniform(0, 6000):,.1f}</td></tr>")
+        iso_items += f"<li>{code}  {name}</li>"
+        alt_rows += f"<tr><td>{code}</td><td>{name} (official)</td><td>{name.upper()}, {code}</td></tr>"
+    return {CO2_PAGE: f'<html><body><table class="wikitable">{co2_rows}</table></body></html>',
+            COUNTRY_CODES_PAGE: f'<html><body><div class="plainlist"><ul>{iso_items}</ul></div></body></html>',
+            ALT_COUNTRY_NAMES_PAGE: f'<html><body><table class="wikitable">{alt_rows}</table></body></html>'}
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Answers requests for the history endpoint, the geocoder, the Wikipedia
+    pages, and /__stats, which returns the request and byte counts.
+    '''
+    protocol_version = 'HTTP/1.1'
+    pages = {}
+    stats = {'requests': {}, 'bytes': 0}
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers=None, counted=True):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        if counted:
+            with self.stats_lock:
+                self.stats['bytes'] += len(data)
+
+    def count(self, endpoint):
+        with self.stats_lock:
+            self.stats['requests'][endpoint] = self.stats['requests'].get(endpoint, 0) + 1
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == '/__stats':
+            with self.stats_lock:
+                body = json.dumps(self.stats)
+            self.send_body(200, body, 'application/json', counted=False)
+        elif url.path.endswith('/air_pollution/history'):
+            self.count('history')
+            body = history_response(float(query['lat']), float(query['lon']), int(query['start']), int(query['end']))
+            self.send_body(200, json.dumps(body), 'application/json')
+        elif url.path == '/geocode/v1/json':
+            self.count('geocode')
+            coordinates = city_coordinates(query.get('q', ''))
+            results = []
+            if coordinates is not None:
+                results = [{'geometry': {'lat': coordinates[0], 'lng': coordinates[1]}, 'components': {}}]
+            body = {'results': results, 'status': {'code': 200, 'message': 'OK'}, 'total_results': len(results)}
+            self.send_body(200, json.dumps(body), 'application/json')
+        elif url.path.startswith('/wiki/'):
+            self.count('wikipedia')
+            html = self.pages[url.path[len('/wiki/'):]]
+            etag = '"' + hashlib.sha256(html.encode('utf-8')).hexdigest()[:16] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_body(200, html, 'text/html; charset=utf-8', {'ETag': etag})
+        else:
+            self.send_body(404, 'not found', 'text/plain')
+
+def run_stub_server(pages, port_queue):
+    '''
+    Runs the stub server until the process is terminated.
+
+    Parameters
+    ----------
+    pages: dict
+        page name -> html of the Wikipedia pages
+    port_queue: multiprocessing.Queue
+        the port the server listens on is put here
+
+    Returns
+    -------
+    none
+    '''
+    StubHandler.pages = pages
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def start_stub_server(pages):
+    '''
+    Starts the stub server in its own process, so serving requests doesn't
+    take time from the code being measured.
+
+    Parameters
+    ----------
+    pages: dict
+        page name -> html of the Wikipedia pages
+
+    Returns
+    -------
+    process: multiprocessing.Process
+        the server process
+    base_url: string
+        url of the server
+    '''
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_stub_server, args=(pages, port_queue), daemon=True)
+    process.start()
+    port = port_queue.get(timeout=30)
+    return process, f"http://localhost:{port}"
+
+def point_project_at(base_url):
+    '''
+    Points every outbound call of project.py at the stub server and lifts
+    the rate limits, which are meant for the real APIs.
+
+    Parameters
+    ----------
+    base_url: string
+        url of the stub server
+
+    Returns
+    -------
+    none
+    '''
+    project.secrets.OCG_API_KEY = 'benchmark'
+    project.secrets.OWM_API_KEY = 'benchmark'
+    project.OWM_HISTORY_URL = base_url + '/data/2.5/air_pollution/history'
+    project.OPENCAGE_PROTOCOL = 'http'
+    project.OPENCAGE_DOMAIN = urlsplit(base_url).netloc
+    project.CO2_EMISSIONS_URL = base_url + '/wiki/' + CO2_PAGE
+    project.COUNTRY_CODES_URL = base_url + '/wiki/' + COUNTRY_CODES_PAGE
+    project.ALT_COUNTRY_NAMES_URL = base_url + '/wiki/' + ALT_COUNTRY_NAMES_PAGE
+    limits = {provider: (1e6, 1e6, None) for provider in project.PROVIDER_LIMITS}
+    project.SCHEDULER = project.RequestScheduler(limits=limits)
+    project._HTTP_SESSION = None
+    project._GEOCODER = None
+
+def use_directory(directory):
+    '''
+    Switches project.py to empty caches and an empty database in directory.
+
+    Parameters
+    ----------
+    directory: string
+        directory for the cache and database files
+
+    Returns
+    -------
+    none
+    '''
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    for name, value in list(vars(project).items()):
+        if isinstance(value, project.CacheStore):
+            setattr(project, name, project.CacheStore(value.table, ttl=value.ttl, max_entries=value.max_entries))
+        elif isinstance(value, project.PollutionDayStore):
+            setattr(project, name, project.PollutionDayStore(value.table))
+    project._DB_LOCAL = threading.local()
+
+def server_stats(base_url):
+    '''
+    Reads the request and byte counts of the stub server.
+
+    Parameters
+    ----------
+    base_url: string
+        url of the stub server
+
+    Returns
+    -------
+    stats: dict
+        'requests' by endpoint and 'bytes' sent
+    '''
+    import requests
+    return requests.get(base_url + '/__stats').json()
+
+def stats_delta(before, after):
+    requests_made = {endpoint: count - before['requests'].get(endpoint, 0)
+            for endpoint, count in after['requests'].items()
+            if count != before['requests'].get(endpoint, 0)}
+    return {'http_requests': requests_made, 'http_bytes': after['bytes'] - before['bytes']}
+
+def measure(results, base_url, name, size, function):
+    '''
+    Runs a benchmark once and records its time and the HTTP requests it made.
+
+    Parameters
+    ----------
+    results: list
+        the result is appended here
+    base_url: string
+        url of the stub server
+    name: string
+        benchmark name
+    size: int
+        number of items processed
+    function: function
+        the code to measure
+
+    Returns
+    -------
+    value: whatever function returns
+    '''
+    before = server_stats(base_url)
+    started = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - started
+    result = {'name': name, 'size': size, 'seconds': round(seconds, 6),
+            'per_item_ms': round(seconds * 1000 / max(size, 1), 6)}
+    result.update(stats_delta(before, server_stats(base_url)))
+    results.append(result)
+    print(f"{name:<32} size={size:<7} {seconds:10.4f}s", file=sys.stderr)
+    return value
+
+def make_scaled_csv(source, filename, scale):
+    '''
+    Writes a WDI csv file with scale copies of every country of source.
+    Copies get new codes and names, so they are separate rows.
+
+    Parameters
+    ----------
+    source: string
+        air pollution csv file
+    filename: string
+        file to write
+    scale: int
+        number of copies of each country
+
+    Returns
+    -------
+    none
+    '''
+    with open(source, encoding='utf-8-sig') as file:
+        lines = file.read().splitlines()
+    header_end = next(index for index, line in enumerate(lines) if line.startswith('"Country Name"')) + 1
+    output = lines[:header_end]
+    for copy in range(scale):
+        for line in lines[header_end:]:
+            if not line.strip():
+                continue
+            if copy == 0:
+                output.append(line)
+            else:
+                output.append(re.sub(r'^"([^"]*)","([^"]*)"', lambda match: f'"{match.group(1)} {copy}","{match.group(2)}{copy}"', line))
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(output) + '\n')
+
+def name_variants(countries, count):
+    '''
+    Returns count spellings of the country names, the way they might be
+    scraped or typed: as is, in capitals, with "The", with text in
+    parentheses, and with a letter missing.
+
+    Parameters
+    ----------
+    countries: list
+        (name, code) tuples
+    count: int
+        number of names
+
+    Returns
+    -------
+    names: list
+        country names
+    '''
+    rng = random.Random(1)
+    names = []
+    while len(names) < count:
+        name = countries[len(names) % len(countries)][0]
+        variant = len(names) // len(countries) % 5
+        if variant == 1:
+            name = name.upper()
+        elif variant == 2:
+            name = 'The ' + name
+        elif variant == 3:
+            name = f"{name} (and dependencies {len(names)})"
+        elif variant == 4 and len(name) > 4:
+            position = rng.randrange(1, len(name) - 1)
+            name = name[:position] + name[position + 1:]
+        names.append(name)
+    return names
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def parse_sizes(text):
+    return [int(size) for size in text.split(',') if size.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark project.py against a local stub server.")
+    parser.add_argument('--cities', type=parse_sizes, default=[10, 100, 1000], help="numbers of cities, such as 10,100,1000")
+    parser.add_argument('--csv-scales', type=parse_sizes, default=[1, 10], help="copies of each csv country, such as 1,10")
+    parser.add_argument('--names', type=parse_sizes, default=[250, 2500], help="numbers of names to resolve")
+    parser.add_argument('--output', help="write the JSON results to this file")
+    parser.add_argument('--keep', action='store_true', help="keep the working directory")
+    args = parser.parse_args(argv)
+
+    source_csv = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), project.AIR_POLLUTION_CSV_FILENAME))
+    countries = [(name, code) for name, code, *values in project.read_air_pollution_rows(source_csv)]
+    process, base_url = start_stub_server(make_pages(countries))
+    point_project_at(base_url)
+    workdir = tempfile.mkdtemp(prefix='air_pollution_benchmark_')
+    start_dir = os.getcwd()
+    results = []
+    try:
+        for count in args.cities:
+            use_directory(os.path.join(workdir, f"cities_{count}"))
+            cities = [city_name(index) for index in range(count)]
+            measure(results, base_url, 'get_pollution_data_cold', count,
+                    lambda: project.get_pollution_data_batch(cities))
+            measure(results, base_url, 'get_pollution_data_warm', count,
+                    lambda: project.get_pollution_data_batch(cities))
+
+        for scale in args.csv_scales:
+            use_directory(os.path.join(workdir, f"csv_{scale}"))
+            make_scaled_csv(source_csv, 'air_pollution.csv', scale)
+            project.AIR_POLLUTION_CSV_FILENAME = os.path.abspath('air_pollution.csv')
+            rows = len(countries) * scale
+            measure(results, base_url, 'create_database_cold', rows, lambda: project.create_database(force=True))
+            measure(results, base_url, 'create_database_unchanged', rows, lambda: project.create_database())
+            cursor = project.get_connection().cursor()
+            cursor.execute("SELECT country FROM air_pollution")
+            names = [row[0] for row in cursor.fetchall()]
+            measure(results, base_url, 'generate_line_graph', len(names),
+                    lambda: [project.generate_line_graph(name, '2') for name in names])
+            cursor.execute("SELECT DISTINCT year FROM series WHERE indicator=?", (project.AIR_POLLUTION_INDICATOR,))
+            years = [row[0] for row in cursor.fetchall()]
+            measure(results, base_url, 'generate_world_map', len(years),
+                    lambda: [project.build_world_map(2, year).render() for year in years])
+
+        country_code_dict = dict((name, code) for name, code in countries)
+        alt_names_codes = project.get_alt_country_names_dict()
+        for count in args.names:
+            names = name_variants(countries, count)
+            resolver = measure(results, base_url, 'country_resolver_build', len(countries),
+                    lambda: project.CountryResolver(country_code_dict=country_code_dict, alt_names_codes=alt_names_codes))
+            measure(results, base_url, 'country_resolution', count, lambda: [resolver.resolve(name) for name in names])
+    finally:
+        os.chdir(start_dir)
+        process.terminate()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'version': git_version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
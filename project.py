@@ -1,18 +1,89 @@
-import requests
 import json
-from opencage.geocoder import OpenCageGeocode
 import sqlite3
 import secrets
-from bs4 import BeautifulSoup
 import csv
 import re
-from fuzzywuzzy import fuzz
-import plotly.graph_objs as go
-import pygal
-import pycountry
+import threading
+import time
+import hashlib
+import unicodedata
+import math
+import random
+import struct
+import functools
+import os
+import sys
+import argparse
+import asyncio
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# requests, opencage, bs4, fuzzywuzzy, plotly, pygal, pycountry and numpy are slow
+# to import, so they are imported inside the functions that use them.
 
 CITY_POLLUTION_CACHE_FILENAME = 'city_pollution.json'
-ALT_COUNTRY_NAMES_CACHE_FILENAME = 'alt_country_names.json'
+CACHE_DB_FILENAME = 'cache.sqlite'
+CITY_POLLUTION_CACHE_TTL = 30 * 24 * 60 * 60
+CITY_POLLUTION_CACHE_MAX_ENTRIES = 10000
+DATABASE_FILENAME = 'CO2_air_pollution.sqlite'
+AIR_POLLUTION_CSV_FILENAME = 'air_pollution.csv'
+WDI_DIRECTORY = 'wdi'
+INGEST_CHUNK_BYTES = 1 << 20
+POPULATION_INDICATOR = 'SP.POP.TOTL'
+CO2_EMISSIONS_URL = 'https://en.wikipedia.org/wiki/List_of_countries_by_carbon_dioxide_emissions'
+COUNTRY_CODES_URL = 'https://en.wikipedia.org/wiki/ISO_3166-1_alpha-3'
+ALT_COUNTRY_NAMES_URL = 'https://en.wikipedia.org/wiki/List_of_alternative_country_names'
+PARSED_PAGE_CACHE_MAX_ENTRIES = 50
+OFFLINE = os.environ.get('AIR_POLLUTION_OFFLINE', '') not in ('', '0')
+METRICS_ENABLED = os.environ.get('AIR_POLLUTION_METRICS', '') not in ('', '0')
+METRICS_PREFIX = 'air_pollution'
+SCHEMA_VERSION = 6
+AIR_POLLUTION_INDICATOR = 'EN.ATM.PM25.MC.M3'
+EMISSIONS_INDICATOR = 'CO2.MT'
+LEGACY_YEARS = {1: 1990, 2: 2005, 3: 2017}
+CHANGE_YEARS = (1990, 2017)
+# derived indicator -> (numerator, denominator, scale); Mt CO2 per person in tonnes
+DERIVED_INDICATORS = {'CO2.PC': (EMISSIONS_INDICATOR, POPULATION_INDICATOR, 1e6)}
+# indicators that get totals, ranks and changes; the full WDI catalogue would make these tables huge
+SUMMARY_INDICATORS = (EMISSIONS_INDICATOR, AIR_POLLUTION_INDICATOR, POPULATION_INDICATOR, *DERIVED_INDICATORS)
+WORLD_REGION = 'world'
+REGIONS = ('africa', 'antartica', 'asia', 'europe', 'north_america', 'oceania', 'south_america')
+MAP_TYPES = {1: (EMISSIONS_INDICATOR, 'emissions'), 2: (AIR_POLLUTION_INDICATOR, 'air_pollution')}
+MAPS_DIRECTORY = 'maps'
+TABLES_DIRECTORY = 'tables'
+ARRAY_TABLE_MAGIC = b'APTABLE1'
+COUNTRY_CODE_OVERRIDES = {'France': 'FRA', 'Italy': 'ITA', 'Switzerland': 'CHE'}
+COUNTRY_NAME_STOPWORDS = {'and', 'of', 'the', 'de'}
+POLLUTION_COMPONENTS = ["AQI", "CO", "NO", "NO2", "O3", "SO2", "PM 2.5", "PM 10", "NH3"]
+OWM_COMPONENT_KEYS = ["co", "no", "no2", "o3", "so2", "pm2_5", "pm10", "nh3"]
+DAY_SECONDS = 24 * 60 * 60
+DEFAULT_HISTORY_START = 1606266000
+DEFAULT_HISTORY_END = 1616817600
+HISTORY_CHUNK_DAYS = 366
+NEARBY_DISTANCE_KM = 5
+SPATIAL_CELL_DEGREES = 0.1
+KM_PER_DEGREE = 111.195
+EARTH_RADIUS_KM = 6371.0
+OWM_HISTORY_URL = 'http://api.openweathermap.org/data/2.5/air_pollution/history'
+OPENCAGE_PROTOCOL = 'https'
+OPENCAGE_DOMAIN = 'api.opencagedata.com'
+HTTP_POOL_SIZE = 32
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8000
+RENDER_CACHE_MAX_ENTRIES = 256
+RENDER_CACHE_TTL = 5 * 60
+SERVER_MAX_WORKERS = 8
+# provider -> (requests per second, burst size, requests per day or None)
+PROVIDER_LIMITS = {'opencage': (1, 1, 2500),
+        'openweathermap': (1, 10, 30000),
+        'wikipedia': (10, 10, None)}
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60
+BATCH_MAX_WORKERS = 8
 
 def open_cache(CACHE_FILENAME):
     ''' opens the cache file if it exists and loads the JSON into
@@ -35,489 +106,4298 @@ def open_cache(CACHE_FILENAME):
         cache_dict = {}
     return cache_dict
 
-def save_cache(cache_dict, CACHE_FILENAME):
-    ''' saves the current state of the cache to disk
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+class Metrics:
+    '''
+    Collects per-stage timings and counters, such as cache hits and misses,
+    HTTP calls and bytes, and database rows written. While it is disabled,
+    timer() returns a shared object that does nothing and count() returns
+    right away, so the instrumentation costs next to nothing.
+
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
-    Cache filename
+    enabled: bool
+        True to collect metrics
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+
+    def timer(self, stage):
+        '''
+        Returns a context manager that times one run of a stage.
+
+        Parameters
+        ----------
+        stage: string
+            stage name
+
+        Returns
+        -------
+        timer: context manager
+        '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            calls, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def count(self, name, value=1, **labels):
+        '''
+        Adds value to a counter.
+
+        Parameters
+        ----------
+        name: string
+            counter name
+        value: number
+            amount to add
+        labels: strings
+            labels of the counter, such as cache='geocodes'
+
+        Returns
+        -------
+        none
+        '''
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        '''
+        Returns the metrics as a JSON serializable dictionary.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        summary: dict
+            'stages' with calls, total and max seconds of each stage, and
+            'counters' with the name, labels and value of each counter
+        '''
+        with self._lock:
+            stages = {stage: {'calls': calls, 'seconds': total, 'max_seconds': longest}
+                    for stage, (calls, total, longest) in sorted(self.stages.items())}
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())]
+        return {'stages': stages, 'counters': counters}
+
+    def prometheus(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        text: string
+            the metrics
+        '''
+        summary = self.summary()
+        lines = [f"# TYPE {METRICS_PREFIX}_stage_calls_total counter",
+                f"# TYPE {METRICS_PREFIX}_stage_seconds_total counter",
+                f"# TYPE {METRICS_PREFIX}_stage_max_seconds gauge"]
+        for stage, values in summary['stages'].items():
+            lines.append(f'{METRICS_PREFIX}_stage_calls_total{{stage="{stage}"}} {values["calls"]}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_total{{stage="{stage}"}} {values["seconds"]:.6f}')
+            lines.append(f'{METRICS_PREFIX}_stage_max_seconds{{stage="{stage}"}} {values["max_seconds"]:.6f}')
+        typed = set()
+        for counter in summary['counters']:
+            name = f"{METRICS_PREFIX}_{counter['name']}_total"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            labels = ','.join(f'{key}="{str(value)}"' for key, value in counter['labels'].items())
+            if labels:
+                lines.append(f"{name}{{{labels}}} {counter['value']}")
+            else:
+                lines.append(f"{name} {counter['value']}")
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics(METRICS_ENABLED)
+
+def timed(stage):
+    '''
+    Decorator that times every call of a function as a stage.
+
+    Parameters
+    ----------
+    stage: string
+        stage name
 
     Returns
     -------
-    None
+    decorator: function
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
-    fw.write(dumped_json_cache)
-    fw.close()
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            with METRICS.timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
 
-CITY_POLLUTION_CACHE = open_cache(CITY_POLLUTION_CACHE_FILENAME)
-ALT_COUNTRY_NAMES_CACHE = open_cache(ALT_COUNTRY_NAMES_CACHE_FILENAME)
+_MISSING = object()
 
-def get_pollution_data(city):
+class CacheStore:
     '''
-    Gets air pollution data for one city for November 27, 2020 - March 27, 2021
-    and returns it. Checks cache for the data. If no data is found in the cache, 
-    then the retrieved data is stored in the cache.
+    Persistent key/value cache stored in one table of a SQLite file.
+    Each key is its own row, so inserts and lookups only touch that row
+    and nothing is loaded until a key is asked for. Every write is a
+    SQLite transaction, so a crash never leaves a half written cache.
+    Entries older than ttl seconds are treated as missing, and when
+    there are more than max_entries rows the least recently used ones
+    are removed.
 
     Parameters
     ----------
-    city: string
-        city name
+    table: string
+        name of the table holding this cache
+    filename: string
+        SQLite file the table lives in
+    ttl: int
+        seconds an entry stays valid, or None to keep entries forever
+    max_entries: int
+        maximum number of entries, or None for no limit
+    legacy_filename: string
+        old JSON cache file imported the first time the table is empty
+    legacy_key: function
+        converts the keys of the old JSON cache file to the keys used now,
+        or None to import them as they are
+    '''
+
+    def __init__(self, table, filename=CACHE_DB_FILENAME, ttl=None, max_entries=None, legacy_filename=None, legacy_key=None):
+        self.table = table
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.legacy_filename = legacy_filename
+        self.legacy_key = legacy_key
+        self._connection = None
+        self._size = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.filename, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    + "created REAL NOT NULL, accessed REAL NOT NULL)")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed)")
+            connection.commit()
+            self._connection = connection
+            self._size = connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if self._size == 0 and self.legacy_filename:
+                legacy = open_cache(self.legacy_filename)
+                if legacy:
+                    if self.legacy_key is not None:
+                        legacy = {self.legacy_key(key): value for key, value in legacy.items()}
+                    self.set_many(legacy.items())
+        return self._connection
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(f"SELECT value, created FROM {self.table} WHERE key=?", (key,)).fetchone()
+            if row is None:
+                METRICS.count('cache_requests', cache=self.table, result='miss')
+                return default
+            now = time.time()
+            if self._expired(row[1], now):
+                self._delete(key)
+                METRICS.count('cache_requests', cache=self.table, result='expired')
+                return default
+            METRICS.count('cache_requests', cache=self.table, result='hit')
+            with connection:
+                connection.execute(f"UPDATE {self.table} SET accessed=? WHERE key=?", (now, key))
+            return json.loads(row[0])
+
+    def set_many(self, items):
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            with connection:
+                for key, value in items:
+                    exists = connection.execute(f"SELECT 1 FROM {self.table} WHERE key=?", (key,)).fetchone()
+                    connection.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                            (key, json.dumps(value), now, now))
+                    if exists is None:
+                        self._size += 1
+            self._evict()
+
+    def _evict(self):
+        if self.max_entries is None or self._size <= self.max_entries:
+            return
+        connection = self._connection
+        with connection:
+            cursor = connection.execute(f"DELETE FROM {self.table} WHERE key IN "
+                    + f"(SELECT key FROM {self.table} ORDER BY accessed LIMIT ?)", (self._size - self.max_entries,))
+            self._size -= cursor.rowcount
+
+    def _delete(self, key):
+        with self._connection:
+            cursor = self._connection.execute(f"DELETE FROM {self.table} WHERE key=?", (key,))
+            self._size -= cursor.rowcount
+
+    def items(self):
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            rows = connection.execute(f"SELECT key, value, created FROM {self.table}").fetchall()
+        return [(key, json.loads(value)) for key, value, created in rows if not self._expired(created, now)]
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(f"DELETE FROM {self.table}")
+            self._size = 0
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set_many([(key, value)])
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._connect()
+            self._delete(key)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            self._connect()
+            return self._size
+
+CITY_POLLUTION_CACHE = CacheStore('city_pollution', ttl=CITY_POLLUTION_CACHE_TTL,
+        max_entries=CITY_POLLUTION_CACHE_MAX_ENTRIES, legacy_filename=CITY_POLLUTION_CACHE_FILENAME,
+        legacy_key=lambda city: normalize_city_name(city))
+GEOCODE_CACHE = CacheStore('geocodes', max_entries=CITY_POLLUTION_CACHE_MAX_ENTRIES)
+QUOTA_CACHE = CacheStore('quotas', ttl=2 * 24 * 60 * 60)
+PAGE_CACHE = CacheStore('pages')
+PARSED_PAGE_CACHE = CacheStore('parsed_pages', max_entries=PARSED_PAGE_CACHE_MAX_ENTRIES)
+
+_HTTP_SESSION = None
+_GEOCODER = None
+_CLIENT_LOCK = threading.Lock()
+# status code of the last OpenCage response seen by each thread
+_GEOCODER_STATUS = threading.local()
+
+def get_http_session():
+    '''
+    Returns the shared requests session used for OpenWeatherMap calls.
+    The session is created on first use and keeps a pool of open
+    connections so repeated calls skip the TCP and TLS handshakes.
+
+    Parameters
+    ----------
+    none
 
     Returns
     -------
-    String stating that the city name is invalid
-    OR
-    city_dict: dict
-        dictionary of air pollution data
+    session: requests.Session
+        the pooled HTTP session
     '''
+    global _HTTP_SESSION
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _CLIENT_LOCK:
+        if _HTTP_SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _HTTP_SESSION = session
+        return _HTTP_SESSION
 
-    if city in CITY_POLLUTION_CACHE:
-        return CITY_POLLUTION_CACHE[city]
-    else:
-        geocoder = OpenCageGeocode(secrets.OCG_API_KEY)
-        response = geocoder.geocode(city)
-        if response == []:
-            return f"Invalid city name: {city}."
-        else:
-            results = response[0]['geometry']
-            lat = results['lat']
-            lon = results['lng']
-            BASE_URL = 'http://api.openweathermap.org/data/2.5/air_pollution/history?'
-            response = requests.get(BASE_URL + f'lat={lat}&lon={lon}&start=1606266000&end=1616817600&appid={secrets.OWM_API_KEY}')
-            data = response.json()
-            raw_data = data['list']
-            count = 0
-            aqi_sum = 0
-            co_sum = 0
-            no_sum = 0
-            no2_sum = 0
-            o3_sum = 0
-            so2_sum = 0
-            pm2_5_sum = 0
-            pm10_sum = 0
-            nh3_sum = 0
-            for item in raw_data:
-                aqi_sum += item["main"]["aqi"]
-                co_sum += item["components"]["co"]
-                no_sum += item["components"]["no"]
-                no2_sum += item["components"]["no2"]
-                o3_sum += item["components"]["o3"]
-                so2_sum += item["components"]["so2"]
-                pm2_5_sum += item["components"]["pm2_5"]
-                pm10_sum += item["components"]["pm10"]
-                nh3_sum += item["components"]["nh3"]
-                count += 1
-            avg_aqi = aqi_sum/count
-            avg_co = co_sum/count
-            avg_no = no_sum/count
-            avg_no2 = no2_sum/count
-            avg_o3 = o3_sum/count
-            avg_so2 = so2_sum/count
-            avg_pm2_5 = pm2_5_sum/count
-            avg_pm10 = pm10_sum/count
-            avg_nh3 = nh3_sum/count
-            city_dict = {"AQI": avg_aqi,
-                    "CO": avg_co,
-                    "NO": avg_no,
-                    "NO2": avg_no2,
-                    "O3": avg_o3,
-                    "SO2": avg_so2,
-                    "PM 2.5": avg_pm2_5,
-                    "PM 10": avg_pm10,
-                    "NH3": avg_nh3}
-            CITY_POLLUTION_CACHE[city] = city_dict
-            save_cache(CITY_POLLUTION_CACHE, CITY_POLLUTION_CACHE_FILENAME)
-            return city_dict
-
-def create_city_pollution_bar_chart(city1, component=None, city2=None, city3=None):
-    '''
-    Generates a bar chart based of one, two, or three cities.
-    If one city is selected, then the chart displays all 9 air air pollution components.
-    If more than one city is selected, then a component will need to be provided. The bar
-    chart displays the values for the selected component across the multiple cities.
+def get_geocoder():
+    '''
+    Returns the shared OpenCage geocoder client. The client gets its own
+    pooled session so every geocode call reuses the same connections. The
+    client's own retries are turned off, so every retry goes through
+    SCHEDULER and counts against the rate limit and the daily quota.
 
     Parameters
     ----------
-    city1: string
-        first city
-    component: string
-        number corresponing to the selected component (1-9)
-    city2: string
-        second city
-    city3: string
-        third city
+    none
 
     Returns
     -------
-    String stating that the city name is invalid
-    OR
-    fig: Plotly figure
-        the bar chart
+    geocoder: OpenCageGeocode
+        the geocoder client
     '''
-    if component == None:
-        city_data = get_pollution_data(city1)
-        if isinstance(city_data, str):
-            return city_data
-        else:
-            xvals = ["CO", "NO", "NO2", "O3", "SO2", "PM 2.5", "PM 10", "NH3"]
-            yvals = [city_data["CO"], city_data["NO"], city_data["NO2"], city_data["O3"], city_data["SO2"],
-                    city_data["PM 2.5"], city_data["PM 10"], city_data["NH3"]]
-            bar_data = go.Bar(x=xvals, y=yvals)
-            layout = go.Layout(title=f"Air Pollution of {city1.title()} in μg/m^3")
-            fig = go.Figure(data=bar_data, layout=layout)
-            return fig
-    else:
-        components = {"1": "AQI", "2": "CO", "3": "NO",
-                    "4": "NO2", "5": "O3", "6": "SO2",
-                    "7": "PM 2.5", "8": "PM 10", "9": "NH3"}
-        city1_data = get_pollution_data(city1)
-        if isinstance(city1_data, str):
-            return city1_data
-        else:
-            if city2 != None:
-                city2_data = get_pollution_data(city2)
-                if isinstance(city2_data, str):
-                    return city2_data
-                else:
-                    if city3 == None:
-                        xvals = [city1.title(), city2.title()]
-                        yvals = [city1_data[components[component]], city2_data[components[component]]]
-                        layout = go.Layout(title=f"Comparing {components[component]} of {city1.title()} and {city2.title()}")
-                        bar_data = go.Bar(x=xvals, y=yvals)
-                        fig = go.Figure(data=bar_data, layout=layout)
-                        return fig
-                    else:
-                        city3_data = get_pollution_data(city3)
-                        if isinstance(city3_data, str):
-                            return city3_data
-                        else:
-                            xvals = [city1.title(), city2.title(), city3.title()]
-                            yvals = [city1_data[components[component]], city2_data[components[component]], city3_data[components[component]]]
-                            layout = go.Layout(title=f"Comparing {component} of {city1.title()}, {city2.title()}, and {city3.title()}")
-                            bar_data = go.Bar(x=xvals, y=yvals)
-                            fig = go.Figure(data=bar_data, layout=layout)
-                            return fig
+    global _GEOCODER
+    import requests
+    from requests.adapters import HTTPAdapter
+    from opencage.geocoder import OpenCageGeocode
+    with _CLIENT_LOCK:
+        if _GEOCODER is None:
+            geocoder = OpenCageGeocode(secrets.OCG_API_KEY, protocol=OPENCAGE_PROTOCOL, domain=OPENCAGE_DOMAIN)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # the client returns parsed results instead of the response, so its
+            # status codes and sizes are counted by a hook on the session
+            session.hooks['response'].append(record_geocoder_response)
+            geocoder.session = session
+            # _opencage_request is wrapped in a backoff decorator that retries for up to
+            # two minutes on its own, so bind the undecorated method instead
+            request = getattr(OpenCageGeocode._opencage_request, '__wrapped__', None)
+            if request is not None:
+                geocoder._opencage_request = request.__get__(geocoder, OpenCageGeocode)
+            _GEOCODER = geocoder
+        return _GEOCODER
 
-def create_country_code_dict():
+def record_geocoder_response(response, *args, **kwargs):
     '''
-    Scrapes country three-letter country codeds from Wikipedia
+    Response hook of the geocoder session. Counts the response in METRICS
+    and keeps its status code for the calling thread, because the client
+    raises the same error for 402 and 429.
+
     Parameters
     ----------
+    response: requests.Response
+        the response
+
+    Returns
+    -------
     none
+    '''
+    _GEOCODER_STATUS.value = response.status_code
+    record_http_response('opencage', response)
+
+def geocode_request(city):
+    '''
+    Sends one geocoding request. A 402 response means the daily quota of
+    the account has been used up, so it raises QuotaExceededError, which
+    is not retried, instead of the rate limit error the client raises.
+
+    Parameters
+    ----------
+    city: string
+        city name
 
     Returns
     -------
-    country_code_dict: dict
-        dictionary with country names and corresponding codes
+    results: list
+        the geocoding results
     '''
+    from opencage.geocoder import RateLimitExceededError
+    _GEOCODER_STATUS.value = None
+    try:
+        return get_geocoder().geocode(city)
+    except RateLimitExceededError as error:
+        if getattr(_GEOCODER_STATUS, 'value', None) == 402:
+            raise QuotaExceededError("Daily quota of opencage requests has been used up.") from error
+        raise
 
-    country_code_dict = {}
-    html = requests.get("https://en.wikipedia.org/wiki/ISO_3166-1_alpha-3").text
-    soup = BeautifulSoup(html, "html.parser")
-    list_items = soup.find(class_='plainlist')
-    for item in list_items.find_all('li'):
-        code_name = item.text
-        code = code_name[0:3]
-        name = code_name[5:]
-        country_code_dict[name] = code
-    return country_code_dict
+class ApiError(Exception):
+    '''
+    Raised when an API call fails after all retries.
+    '''
 
-def get_alt_country_names_dict():
+class QuotaExceededError(ApiError):
+    '''
+    Raised when the daily quota of a provider has been used up.
+    '''
+
+class TokenBucket:
     '''
-    Checks cache file for data. If not found,
-    scrapes alternative country names and codes from Wikipedia
+    Token bucket rate limiter. Tokens are added at a fixed rate up to the
+    capacity of the bucket, and each call takes one token, waiting for it
+    if the bucket is empty.
 
     Parameters
     ----------
-    none
+    rate: float
+        tokens added per second
+    capacity: int
+        maximum number of tokens, which is the largest burst of calls
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+def is_retryable_error(error):
+    '''
+    Checks if an exception raised by an API call is worth retrying:
+    connection errors, timeouts, rate limit errors (429) and OpenCage server
+    errors. QuotaExceededError is never retried.
+
+    Parameters
+    ----------
+    error: Exception
+        the exception
 
     Returns
     -------
-    alt_names_codes_dict: dict
-        dictionay containing official country name, alternative names, and code
+    retryable: bool
+        True if the call should be retried
     '''
+    import requests
+    from opencage.geocoder import RateLimitExceededError, UnknownError
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+            RateLimitExceededError, UnknownError))
 
-    if ALT_COUNTRY_NAMES_CACHE:
-        return ALT_COUNTRY_NAMES_CACHE
-    else:
-        alt_names_codes_dict = {}
-        html = requests.get("https://en.wikipedia.org/wiki/List_of_alternative_country_names").text
-        soup = BeautifulSoup(html, 'html.parser')
-        tables = soup.find_all(class_ = "wikitable")
-        for table in tables:
-            for row in table.find_all('tr')[1:]:
-                cells = row.find_all('td')
-                code = cells[0].text.strip()
-                name = cells[1].text.strip()
-                alt_name = cells[2].text.strip()
-                simple_name = re.sub(r"\([^()]*\)", "", name)
-                simple_alt_name = re.sub(r"\([^()]*\)", "", alt_name) 
-                alt_name_code = {}
-                alt_name_code['code'] = code
-                alt_name_code['alt_names'] = simple_alt_name.strip()
-                alt_names_codes_dict[simple_name.strip()] = alt_name_code
-        save_cache(alt_names_codes_dict, ALT_COUNTRY_NAMES_CACHE_FILENAME)
-        return alt_names_codes_dict
-
-def create_database():
+def record_http_response(provider, response):
     '''
-    Creates database of CO2 emissions per country and air pollution per country.
-    Air pollution is from a local csv file.
-    Emissions is scraped from Wikipedia.
-    Codes for the each country in the emissions table are found.
-    Air pollution is from a local csv file.
+    Counts the status code and the size of an HTTP response in METRICS.
 
     Parameters
     ----------
-    none
+    provider: string
+        provider the response came from
+    response: requests.Response
+        the response
 
     Returns
     -------
     none
     '''
-    connection = sqlite3.connect("CO2_air_pollution.sqlite")
-    cursor = connection.cursor()
+    METRICS.count('http_responses', provider=provider, status=response.status_code)
+    METRICS.count('http_bytes', len(response.content or b''), provider=provider)
 
-    ### add air pollution per country to database ###
-    with open('air_pollution.csv') as file:
-        rows = csv.reader(file, delimiter=',')
-        cursor.execute("CREATE TABLE IF NOT EXISTS air_pollution (country CHAR(30), country_code CHAR(3), '1990' FLOAT, '2005' FLOAT, '2017' FLOAT)")
-        line_count = 0
-        for row in rows:
-            if line_count < 5:
-                pass
-            else:
-                vals = (row[0], row[1], row[34], row[49], row[61])
-                query = "INSERT INTO air_pollution (country, country_code, '1990', '2005', '2017') VALUES(?, ?, ?, ?, ?)"
-                cursor.execute(query, vals)
-                connection.commit()
-            line_count += 1
-    
-    ### get CO2 data form wikipedia ###
-    html = requests.get('https://en.wikipedia.org/wiki/List_of_countries_by_carbon_dioxide_emissions').text
-    soup = BeautifulSoup(html, 'html.parser')
-    table = soup.find('table', class_='wikitable')
-    country_names = []
-    emissions_1990 = []
-    emissions_2005 = []
-    emissions_2017 = []
-    rows = table.find_all('tr')[5:]
-    for row in rows:
-        cells = row.find_all('td')
-        name = cells[0]
-        country_names.append(name.text.strip())
-
-        e_1990 = cells[1]
-        emissions_1990.append(e_1990.text.strip())
-
-        e_2005 = cells[2]
-        emissions_2005.append(e_2005.text.strip())
-
-        e_2017 = cells[3]
-        emissions_2017.append(e_2017.text.strip())
-
-    ### add CO2 data per country to database ###
-    cursor.execute("CREATE TABLE IF NOT EXISTS emissions (country CHAR(30), country_code CHAR(3), '1990' FLOAT, '2005' FLOAT, '2017' FLOAT)")
-    query = "INSERT INTO emissions (country, country_code, '1990', '2005', '2017') VALUES(?, ?, ?, ?, ?)"
-    country_code_dict = create_country_code_dict()
-    alt_names_codes = get_alt_country_names_dict()
-    count = 0
-    for country in country_names:
-        if 'France' in country:
-            code = 'FRA'
-        elif 'Italy' in country:
-            code = 'ITA'
-        elif 'Switzerland' in country:
-            code = 'CHE'
+class RequestScheduler:
+    '''
+    Sends every outbound API call. Each provider has a token bucket that
+    limits its calls per second, and a daily quota that is saved in the
+    cache so it holds across runs. Calls that fail with 429, a 5xx status
+    or a retryable error are retried with exponential backoff and jitter,
+    honoring Retry-After. Calls with the same key that run at the same time
+    are coalesced, so only one of them reaches the provider and the others
+    get its result.
+
+    Parameters
+    ----------
+    limits: dict
+        provider -> (requests per second, burst size, requests per day or None)
+    max_retries: int
+        number of retries after the first attempt
+    backoff: float
+        seconds to wait before the first retry, doubled for each retry
+    '''
+
+    def __init__(self, limits=PROVIDER_LIMITS, max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS):
+        self.limits = limits
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.buckets = {provider: TokenBucket(rate, burst) for provider, (rate, burst, daily) in limits.items()}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def call(self, provider, function, key=None, retryable=is_retryable_error):
+        '''
+        Calls a function that makes one API request, with rate limiting,
+        retries and coalescing.
+
+        Parameters
+        ----------
+        provider: string
+            provider name from PROVIDER_LIMITS
+        function: function
+            makes the request and returns the response
+        key: hashable
+            identifies the request for coalescing, or None to never coalesce
+        retryable: function
+            returns True for exceptions that should be retried
+
+        Returns
+        -------
+        response: whatever function returns
+        '''
+        if key is None:
+            return self._call_with_retries(provider, function, retryable)
+        with self._lock:
+            flight = self._in_flight.get((provider, key))
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._in_flight[(provider, key)] = flight
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._call_with_retries(provider, function, retryable)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[(provider, key)]
+            flight.event.set()
+        return flight.result
+
+    def _use_quota(self, provider):
+        daily = self.limits[provider][2]
+        if daily is None:
+            return
+        with self._lock:
+            key = f"{provider}:{int(time.time()) // DAY_SECONDS}"
+            used = QUOTA_CACHE.get(key, 0)
+            if used >= daily:
+                raise QuotaExceededError(f"Daily quota of {daily} requests to {provider} has been used up.")
+            QUOTA_CACHE[key] = used + 1
+
+    def _use_up_quota(self, provider):
+        # the provider refused the account for today, so later calls fail
+        # here instead of sending requests that are refused too
+        daily = self.limits[provider][2]
+        if daily is None:
+            return
+        with self._lock:
+            QUOTA_CACHE[f"{provider}:{int(time.time()) // DAY_SECONDS}"] = daily
+
+    def _delay(self, attempt, response=None):
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+        if retry_after is not None and retry_after.strip().isdigit():
+            return min(float(retry_after), MAX_BACKOFF_SECONDS)
+        delay = min(self.backoff * 2 ** attempt, MAX_BACKOFF_SECONDS)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _call_with_retries(self, provider, function, retryable):
+        for attempt in range(self.max_retries + 1):
+            self._use_quota(provider)
+            self.buckets[provider].acquire()
+            METRICS.count('http_requests', provider=provider)
+            try:
+                with METRICS.timer(f"http_{provider}"):
+                    response = function()
+            except QuotaExceededError:
+                METRICS.count('http_errors', provider=provider)
+                self._use_up_quota(provider)
+                raise
+            except Exception as error:
+                METRICS.count('http_errors', provider=provider)
+                if attempt < self.max_retries and retryable(error):
+                    time.sleep(self._delay(attempt))
+                    continue
+                raise
+            status = getattr(response, 'status_code', None)
+            if status is not None:
+                record_http_response(provider, response)
+            if status is not None and (status == 429 or status >= 500) and attempt < self.max_retries:
+                time.sleep(self._delay(attempt, response))
+                continue
+            return response
+
+SCHEDULER = RequestScheduler()
+
+def history_to_arrays(raw_data):
+    '''
+    Converts the hourly records returned by the OpenWeatherMap history
+    endpoint to columnar arrays, sorted by time.
+
+    Parameters
+    ----------
+    raw_data: list
+        the 'list' part of the history response
+
+    Returns
+    -------
+    dt: numpy array
+        unix timestamp of each record
+    values: numpy array
+        one row per record and one column per component in POLLUTION_COMPONENTS
+    '''
+    import numpy as np
+    dt = np.array([item["dt"] for item in raw_data], dtype=np.int64)
+    values = np.array([[item["main"]["aqi"]] + [item["components"][key] for key in OWM_COMPONENT_KEYS]
+            for item in raw_data], dtype=np.float64).reshape(-1, len(POLLUTION_COMPONENTS))
+    order = np.argsort(dt, kind='stable')
+    return dt[order], values[order]
+
+def rollup(dt, values, period, offset=0):
+    '''
+    Averages a series over fixed periods, such as days or weeks.
+
+    Parameters
+    ----------
+    dt: numpy array
+        unix timestamps
+    values: numpy array
+        component values
+    period: int
+        length of a period in seconds
+    offset: int
+        seconds added to the timestamps before splitting them into periods
+
+    Returns
+    -------
+    rollup_dict: dict
+        'start' with the first date of each period, and the mean of each
+        component in each period
+    '''
+    import numpy as np
+    buckets, inverse = np.unique((dt + offset) // period, return_inverse=True)
+    sums = np.zeros((len(buckets), values.shape[1]))
+    np.add.at(sums, inverse, values)
+    means = sums / np.bincount(inverse)[:, None]
+    starts = (buckets * period - offset).astype('datetime64[s]')
+    rollup_dict = {'start': np.datetime_as_string(starts, unit='D').tolist()}
+    for index, component in enumerate(POLLUTION_COMPONENTS):
+        rollup_dict[component] = means[:, index].tolist()
+    return rollup_dict
+
+def aggregate_pollution(dt, values):
+    '''
+    Computes statistics of every component of a pollution series at once:
+    mean, median, 95th percentile, maximum, and daily and weekly means.
+
+    Parameters
+    ----------
+    dt: numpy array
+        unix timestamps
+    values: numpy array
+        component values
+
+    Returns
+    -------
+    stats: dict
+        'count', then 'mean', 'median', 'p95' and 'max' dictionaries keyed by
+        component, and 'daily' and 'weekly' rollups
+    '''
+    import numpy as np
+    values = values.astype(np.float64)
+    stats = {'count': int(len(dt))}
+    columns = {'mean': values.mean(axis=0),
+            'median': np.median(values, axis=0),
+            'p95': np.percentile(values, 95, axis=0),
+            'max': values.max(axis=0)}
+    for name, column in columns.items():
+        stats[name] = dict(zip(POLLUTION_COMPONENTS, column.tolist()))
+    stats['daily'] = rollup(dt, values, DAY_SECONDS)
+    # the unix epoch is a Thursday, so shift by 3 days to start weeks on Monday
+    stats['weekly'] = rollup(dt, values, 7 * DAY_SECONDS, 3 * DAY_SECONDS)
+    return stats
+
+class ArrayTable:
+    '''
+    Compact table of float values, one row per key (a city name or a country
+    code) and one column per label (a pollution component or a year). The
+    values live in one NumPy array, and each key is interned and mapped to
+    its row number, so a table of many cities costs 8 bytes per value
+    instead of a dictionary per city. Missing values are NaN.
+
+    Tables can be saved to a binary file and loaded back with a memory map,
+    so loading is zero-copy and the file can be shared between processes.
+
+    Parameters
+    ----------
+    columns: list
+        column labels
+    keys: list
+        row keys, or None for an empty table
+    values: numpy array
+        one row per key and one column per label, or None for an empty table
+    '''
+
+    __slots__ = ('columns', 'keys', 'index', 'column_index', '_values', '_count')
+
+    def __init__(self, columns, keys=None, values=None):
+        import numpy as np
+        self.columns = [str(column) for column in columns]
+        self.column_index = {column: number for number, column in enumerate(self.columns)}
+        self.keys = [sys.intern(key) for key in keys or []]
+        self.index = {key: number for number, key in enumerate(self.keys)}
+        if values is None:
+            values = np.full((max(len(self.keys), 8), len(self.columns)), np.nan)
+        self._values = values
+        self._count = len(self.keys)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return key in self.index
+
+    @property
+    def values(self):
+        '''The rows in use, as a read-only view.'''
+        view = self._values[:self._count]
+        view.flags.writeable = False
+        return view
+
+    def add(self, key, row):
+        '''
+        Adds a row, or replaces the row of a key that is already in the table.
+
+        Parameters
+        ----------
+        key: string
+            row key
+        row: dict or list
+            values by column label, or values in column order
+
+        Returns
+        -------
+        number: int
+            row number of the key
+        '''
+        import numpy as np
+        number = self.index.get(key)
+        if number is None:
+            if self._count == len(self._values) or not self._values.flags.writeable:
+                grown = np.full((max(2 * len(self._values), 8), len(self.columns)), np.nan)
+                grown[:self._count] = self._values[:self._count]
+                self._values = grown
+            number = self._count
+            key = sys.intern(key)
+            self.keys.append(key)
+            self.index[key] = number
+            self._count += 1
+        if isinstance(row, dict):
+            self._values[number] = [row.get(column, np.nan) for column in self.columns]
+        else:
+            self._values[number] = row
+        return number
+
+    def row(self, key):
+        '''
+        Returns the values of one key as a read-only array, or None if the
+        key isn't in the table.
+        '''
+        number = self.index.get(key)
+        if number is None:
+            return None
+        return self.values[number]
+
+    def column(self, label):
+        '''
+        Returns the values of one column for every key as a read-only array.
+        '''
+        return self.values[:, self.column_index[str(label)]]
+
+    def to_dict(self, key):
+        '''
+        Returns the values of one key as a dictionary keyed by column label,
+        or None if the key isn't in the table.
+        '''
+        row = self.row(key)
+        if row is None:
+            return None
+        return dict(zip(self.columns, row.tolist()))
+
+    def save(self, filename):
+        '''
+        Writes the table to a binary file: a header with the keys and column
+        labels, followed by the values as little-endian float64.
+
+        Parameters
+        ----------
+        filename: string
+            file to write
+
+        Returns
+        -------
+        none
+        '''
+        import numpy as np
+        header = json.dumps({'columns': self.columns, 'keys': self.keys}).encode('utf-8')
+        offset = len(ARRAY_TABLE_MAGIC) + 8 + len(header)
+        padding = -offset % 8
+        temp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(temp_filename, 'wb') as file:
+            file.write(ARRAY_TABLE_MAGIC)
+            file.write(struct.pack('<Q', len(header) + padding))
+            file.write(header + b' ' * padding)
+            file.write(np.ascontiguousarray(self.values, dtype='<f8').tobytes())
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Loads a table written by save. The values are memory mapped, so
+        nothing is copied until rows are changed.
+
+        Parameters
+        ----------
+        filename: string
+            file to read
+
+        Returns
+        -------
+        table: ArrayTable
+            the table, or None if the file isn't a saved table
+        '''
+        import numpy as np
+        with open(filename, 'rb') as file:
+            if file.read(len(ARRAY_TABLE_MAGIC)) != ARRAY_TABLE_MAGIC:
+                return None
+            header_length = struct.unpack('<Q', file.read(8))[0]
+            header = json.loads(file.read(header_length).decode('utf-8'))
+        offset = len(ARRAY_TABLE_MAGIC) + 8 + header_length
+        shape = (len(header['keys']), len(header['columns']))
+        if shape[0] == 0:
+            values = np.full((8, shape[1]), np.nan)
         else:
-            query1 = "SELECT country_code FROM air_pollution WHERE country=?"
-            cursor.execute(query1, (country,))
-            code_unformatted = cursor.fetchall()
-            if code_unformatted == []:
-                for name1 in alt_names_codes:
-                    if country == name1 or country in alt_names_codes[name1]['alt_names']:
-                        code = alt_names_codes[name1]['code']
-                for name2 in country_code_dict:
-                    similarity = fuzz.ratio(name2, country)
-                    if country == name2 or similarity > 77 or name2 in country or country in name2:
-                        code = country_code_dict[name2]
+            values = np.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=shape)
+        return cls(header['columns'], header['keys'], values)
+
+class PollutionDayStore:
+    '''
+    Stores hourly air pollution records in a table of the cache file, one
+    row per location and day. Each row holds the raw bytes of the timestamp
+    and float64 component arrays of that day, so any range of days can be read with
+    one indexed query and only the days that are missing have to be fetched.
+
+    Parameters
+    ----------
+    table: string
+        name of the table holding the records
+    filename: string
+        SQLite file the table lives in
+    '''
+
+    def __init__(self, table='pollution_days', filename=CACHE_DB_FILENAME):
+        self.table = table
+        self.filename = filename
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.filename, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (location TEXT, day INTEGER, dt BLOB, "
+                    + "vals BLOB, PRIMARY KEY (location, day)) WITHOUT ROWID")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table}_locations (location TEXT PRIMARY KEY, "
+                    + "lat REAL, lon REAL, cell_lat INTEGER, cell_lon INTEGER)")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_locations_cell ON {self.table}_locations "
+                    + "(cell_lat, cell_lon)")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def find_location(self, lat, lon, max_distance_km=NEARBY_DISTANCE_KM):
+        '''
+        Finds the location to store the records of a point under. Locations
+        are indexed by grid cell, so only the cells around the point are
+        searched. If a stored location is within max_distance_km of the
+        point, the nearest one is returned. Otherwise the point is added as
+        a new location.
+
+        Parameters
+        ----------
+        lat: float
+            latitude
+        lon: float
+            longitude
+        max_distance_km: float
+            distance within which a stored location is reused
+
+        Returns
+        -------
+        location: string
+            location key
+        lat, lon: float
+            coordinates of the location
+        '''
+        cell_lat = math.floor(lat / SPATIAL_CELL_DEGREES)
+        cell_lon = math.floor(lon / SPATIAL_CELL_DEGREES)
+        lat_cells = math.ceil(max_distance_km / (KM_PER_DEGREE * SPATIAL_CELL_DEGREES))
+        lon_km_per_degree = KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)
+        lon_cells = min(math.ceil(max_distance_km / (lon_km_per_degree * SPATIAL_CELL_DEGREES)),
+                math.ceil(180 / SPATIAL_CELL_DEGREES))
+        # the cells wrap around at 180 degrees longitude, so the range is also
+        # searched one full turn to the east and to the west
+        turn = round(360 / SPATIAL_CELL_DEGREES)
+        with self._lock:
+            connection = self._connect()
+            rows = connection.execute(f"SELECT location, lat, lon FROM {self.table}_locations "
+                    + "WHERE cell_lat BETWEEN ? AND ? AND (cell_lon BETWEEN ? AND ? "
+                    + "OR cell_lon BETWEEN ? AND ? OR cell_lon BETWEEN ? AND ?)",
+                    (cell_lat - lat_cells, cell_lat + lat_cells, cell_lon - lon_cells, cell_lon + lon_cells,
+                    cell_lon - lon_cells + turn, cell_lon + lon_cells + turn,
+                    cell_lon - lon_cells - turn, cell_lon + lon_cells - turn)).fetchall()
+            nearest = None
+            for location, location_lat, location_lon in rows:
+                distance = haversine_km(lat, lon, location_lat, location_lon)
+                if distance <= max_distance_km and (nearest is None or distance < nearest[0]):
+                    nearest = (distance, location, location_lat, location_lon)
+            if nearest is not None:
+                return nearest[1], nearest[2], nearest[3]
+            location = f"{lat:.4f},{lon:.4f}"
+            with connection:
+                connection.execute(f"INSERT OR IGNORE INTO {self.table}_locations (location, lat, lon, cell_lat, cell_lon) "
+                        + "VALUES (?, ?, ?, ?, ?)", (location, lat, lon, cell_lat, cell_lon))
+            return location, lat, lon
+
+    def load(self, location, first_day, last_day):
+        '''
+        Reads the stored days of a location.
+
+        Parameters
+        ----------
+        location: string
+            location key
+        first_day: int
+            first day, counted in days since 1970-01-01
+        last_day: int
+            last day, counted in days since 1970-01-01
+
+        Returns
+        -------
+        days: dict
+            day -> (dt, values) arrays
+        '''
+        import numpy as np
+        with self._lock:
+            rows = self._connect().execute(f"SELECT day, dt, vals FROM {self.table} WHERE location=? "
+                    + "AND day BETWEEN ? AND ?", (location, first_day, last_day)).fetchall()
+        days = {}
+        for day, dt, vals in rows:
+            dt = np.frombuffer(dt, dtype='<i8')
+            if len(vals) == len(dt) * len(POLLUTION_COMPONENTS) * 8:
+                values = np.frombuffer(vals, dtype='<f8')
             else:
-                code = code_unformatted[0][0]
-        vals = (country, code, emissions_1990[count], emissions_2005[count], emissions_2017[count])
-        cursor.execute(query, vals)
-        connection.commit()
-        count += 1
+                # rows written by older versions hold float32 values; going
+                # through their shortest decimal form gives back the values
+                # the API returned instead of the nearest float32
+                values = np.frombuffer(vals, dtype='<f4').astype(str).astype(np.float64)
+            days[day] = (dt, values.reshape(-1, len(POLLUTION_COMPONENTS)))
+        return days
 
-def generate_world_map(map_type, year):
+    def save(self, location, days):
+        '''
+        Stores days of a location in one transaction.
+
+        Parameters
+        ----------
+        location: string
+            location key
+        days: dict
+            day -> (dt, values) arrays
+
+        Returns
+        -------
+        none
+        '''
+        rows = [(location, day, dt.astype('<i8').tobytes(), values.astype('<f8').tobytes())
+                for day, (dt, values) in days.items()]
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(f"INSERT OR REPLACE INTO {self.table} (location, day, dt, vals) "
+                        + "VALUES (?, ?, ?, ?)", rows)
+
+POLLUTION_DAYS = PollutionDayStore()
+
+def haversine_km(lat1, lon1, lat2, lon2):
     '''
-    Generates a world map with either CO2 emissions or air pollution data
-    for a given year.
+    Computes the great-circle distance between two points.
 
     Parameters
     ----------
-    map_type: int
-        1 for emissions, 2 for air pollution
-    year: int
-        1 for 1990, 2 for 2005, or 3 for 2017
+    lat1, lon1: float
+        coordinates of the first point
+    lat2, lon2: float
+        coordinates of the second point
 
     Returns
     -------
-    none
+    distance: float
+        distance in kilometers
     '''
-    worldmap_chart = pygal.maps.world.World()
-    connection = sqlite3.connect("CO2_air_pollution.sqlite")
-    cursor = connection.cursor()
-    years = {1 : '1990', 2: '2005', 3: '2017'}
-    if map_type == 1:
-        worldmap_chart.title = f"CO2 Emissions by Country in {years[year]}"
-        cursor.execute("SELECT * FROM emissions")
-        code_emissions_dict = {}
-        for row in cursor:
-            try:
-                country = pycountry.countries.get(alpha_3=row[1].strip())
-                new_code = country.alpha_2
-            except:
-                pass
-            code_emissions_dict[new_code.lower()] = int(float(str(row[year + 1]).replace(',', '')))
-        worldmap_chart.add('Mt CO2', code_emissions_dict)
-        worldmap_chart.render_in_browser()
-    elif map_type == 2:
-        worldmap_chart.title = f"Air Pollution by Country in {years[year]}"
-        cursor.execute("SELECT * FROM air_pollution")
-        code_pollution_dict = {}
-        for row in cursor:
-            try:
-                country = pycountry.countries.get(alpha_3=row[1].strip())
-                new_code = country.alpha_2
-            except:
-                pass
-            if row[year + 1] == '':
-                pass
-            else:
-                code_pollution_dict[new_code.lower()] = int(row[year+1])
-        worldmap_chart.add("Annual Exposure", code_pollution_dict)
-        worldmap_chart.render_in_browser()
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
 
-def generate_line_graph(country, graph_type):
+def normalize_city_name(city):
     '''
-    Generates a line graph based on air pollution or emissions for a given country.
+    Normalizes a city name so different spellings of the same query, such as
+    "New York" and " new  york ", share one cache entry. Removes accents and
+    punctuation and lowercases the rest.
 
     Parameters
     ----------
-    country: string
-        country name
-    graph_type: string
-        1 for emissions, 2 for air pollution
-    
+    city: string
+        city name
+
     Returns
     -------
-    String stating that there is no data for the country
-    OR
-    fig: Plotly figure
-        the line graph
+    key: string
+        normalized name
     '''
-    connection = sqlite3.connect("CO2_air_pollution.sqlite")
-    cursor = connection.cursor()
-    if graph_type == '1':
-        cursor.execute("SELECT * FROM emissions")
-        for row in cursor:
-            if country.title() in row[0] or row[0] in country.title():
-                if row[2] == '':
-                    return f"No data for {row[0]}"
-                else:
-                    yvals = [row[2], row[3], row[4]]
-                    xvals = ['1990', '2005', '2017']
-                    line_data = go.Scatter(x=xvals, y=yvals)
-                    layout = go.Layout(title=f"CO2 Emissions for {row[0]} from 1990-2017")
-                    fig = go.Figure(data=line_data, layout=layout)
-                    return fig
-    elif graph_type == '2':
-        cursor.execute("SELECT * FROM air_pollution")
-        for row in cursor:
-            if country.title() in row[0] or row[0] in country.title():
-                if row[2] == '':
-                    return f"No data for {row[0]}"
-                else:
-                    yvals = [row[2], row[3], row[4]]
-                    xvals = ['1990', '2005', '2017']
-                    line_data = go.Scatter(x=xvals, y=yvals)
-                    layout = go.Layout(title=f"Air Pollution for {row[0]} from 1990-2017")
-                    fig = go.Figure(data=line_data, layout=layout)
-                    return fig
-if __name__ == "__main__":
-     create_database()
-     while True:
-        print("\n1. Air pollution data for one city.\n2. Comparing air pollution data for multiple cities.\n" +
-        "3. Air pollution or CO2 emissions for one country from 1990-2017.\n4. Air pollution or CO2 emissions globally for one year.")
-        data_type = input("\nEnter the number corresponding to the data you would like to explore or enter 'exit': ")
-        if data_type.strip() == '1':
-            while True:
-                city1 = input("\nEnter a city name, state (optional), and country: ")
-                results = create_city_pollution_bar_chart(city1)
-                if isinstance(results, str):
-                    print(results)
-                else:
-                    results.show()
-                    break
-        elif data_type.strip() == '2':
-            while True:
-                city1 = input("Enter a city name, state (optional), and country: ")
-                city2 = input("Enter another: ")
-                city3 = input("Enter another or enter 'done' to compare just two cities: ")
-                print("\n1. Air Quality Index (AQI)\n2. Carbon Monoxide (CO)\n3. Nitrogen Monoxide (NO)\n4. Nitrogen Dioxide (NO2)\n5. Ozone (O3)\n"
-                + "6. Sulphur Dioxide (SO2)\n7. Particulates < 2.5 micrometers\n8. Particulates < 10 micrometers\n9. Ammonia (NH3)")
-                component = input("\nEnter the number an air polllution component from the above list to compare across the cities: ")
-                if int(component) not in range(1, 10):
-                    print("\nInvalid selection.")
-                else:
-                    if city3.strip().lower() == 'done':
-                        results = create_city_pollution_bar_chart(city1, component, city2)
-                        if isinstance(results, str):
-                            print(results)
-                        else:
-                            results.show()
-                            break
-                    else:
-                        results = create_city_pollution_bar_chart(city1, component, city2, city3)
-                        if isinstance(results, str):
-                            print(results)
-                        else:
-                            results.show()
-                            break
-        elif data_type.strip() == '3':
-            while True:
-                country = input('\nEnter a country name: ')
-                print("\n1. CO2 Emissions\n2. Air Pollution")
-                graph_type = input('\nEnter the number corresponding to the data you wish to explore: ')
-                if int(graph_type.strip()) not in range(1,3):
-                    print("\nInvalid selection.")
-                else:
-                    data = generate_line_graph(country, graph_type)
-                    if isinstance(data, str):
-                        print(data)
-                    elif isinstance(data, go.Figure):
-                        data.show()
-                        break
-                    else:
-                        print("\nInvalid country name.")
-        elif data_type.strip() == '4':
+    city = unicodedata.normalize('NFKD', city)
+    city = ''.join(char for char in city if not unicodedata.combining(char))
+    return re.sub(r"[^\w]+", " ", city.lower()).strip()
+
+@timed('geocode')
+def geocode_city(city):
+    '''
+    Finds the coordinates of a city, using the cache when the same
+    normalized city name was looked up before.
+
+    Parameters
+    ----------
+    city: string
+        city name
+
+    Returns
+    -------
+    coordinates: tuple
+        (lat, lon), or None if the city name is invalid
+    '''
+    key = normalize_city_name(city)
+    cached = GEOCODE_CACHE.get(key)
+    if cached is not None:
+        return tuple(cached)
+    try:
+        response = SCHEDULER.call('opencage', lambda: geocode_request(city), key=key)
+    except ApiError:
+        raise
+    except Exception as error:
+        raise ApiError(f"Geocoding failed: {error!r}") from error
+    if response == []:
+        return None
+    results = response[0]['geometry']
+    coordinates = (results['lat'], results['lng'])
+    GEOCODE_CACHE[key] = coordinates
+    return coordinates
+
+def fetch_history(lat, lon, start, end):
+    '''
+    Downloads the hourly air pollution history of a location.
+
+    Parameters
+    ----------
+    lat: float
+        latitude
+    lon: float
+        longitude
+    start: int
+        unix time of the first record
+    end: int
+        unix time of the last record
+
+    Returns
+    -------
+    dt: numpy array
+        unix timestamps
+    values: numpy array
+        component values
+    '''
+    params = {'lat': lat, 'lon': lon, 'start': start, 'end': end, 'appid': secrets.OWM_API_KEY}
+    try:
+        response = SCHEDULER.call('openweathermap', lambda: get_http_session().get(OWM_HISTORY_URL, params=params, timeout=30),
+                key=(lat, lon, start, end))
+    except ApiError:
+        raise
+    except Exception as error:
+        raise ApiError(f"OpenWeatherMap request failed: {error!r}") from error
+    if response.status_code != 200:
+        raise ApiError(f"OpenWeatherMap returned status {response.status_code}")
+    try:
+        with METRICS.timer('json_decode'):
+            raw_data = response.json()['list']
+    except (ValueError, KeyError, TypeError) as error:
+        raise ApiError("OpenWeatherMap returned an invalid response") from error
+    with METRICS.timer('history_to_arrays'):
+        return history_to_arrays(raw_data)
+
+def split_into_chunks(days, chunk_days=HISTORY_CHUNK_DAYS):
+    '''
+    Groups sorted days into runs of consecutive days that are at most
+    chunk_days long.
+
+    Parameters
+    ----------
+    days: list
+        sorted days
+    chunk_days: int
+        maximum length of a run
+
+    Returns
+    -------
+    chunks: list
+        (first_day, last_day) tuples
+    '''
+    chunks = []
+    for day in days:
+        if chunks and day == chunks[-1][1] + 1 and day - chunks[-1][0] < chunk_days:
+            chunks[-1][1] = day
+        else:
+            chunks.append([day, day])
+    return [tuple(chunk) for chunk in chunks]
+
+def fetch_history_days(lat, lon, first_day, last_day):
+    '''
+    Downloads whole days of hourly history and splits them by day.
+    Days without records are returned as empty arrays.
+
+    Parameters
+    ----------
+    lat: float
+        latitude
+    lon: float
+        longitude
+    first_day: int
+        first day, counted in days since 1970-01-01
+    last_day: int
+        last day, counted in days since 1970-01-01
+
+    Returns
+    -------
+    days: dict
+        day -> (dt, values) arrays
+    '''
+    import numpy as np
+    dt, values = fetch_history(lat, lon, first_day * DAY_SECONDS, (last_day + 1) * DAY_SECONDS - 1)
+    bounds = np.searchsorted(dt, np.arange(first_day, last_day + 2) * DAY_SECONDS)
+    days = {}
+    for index, day in enumerate(range(first_day, last_day + 1)):
+        days[day] = (dt[bounds[index]:bounds[index + 1]], values[bounds[index]:bounds[index + 1]])
+    return days
+
+def get_history_range(start=None, end=None):
+    '''
+    Fills in the default start and end of a pollution history. With neither
+    given, the range is November 27, 2020 - March 27, 2021. With only start
+    given, the range ends now.
+
+    Parameters
+    ----------
+    start: int
+        unix time of the start, or None
+    end: int
+        unix time of the end, or None
+
+    Returns
+    -------
+    start: int
+        unix time of the start
+    end: int
+        unix time of the end
+    '''
+    if end is None:
+        if start is None:
+            end = DEFAULT_HISTORY_END
+        else:
+            end = int(time.time())
+    if start is None:
+        start = DEFAULT_HISTORY_START
+    return int(start), int(end)
+
+@timed('get_pollution_series')
+def get_pollution_series(city, start=None, end=None, max_workers=BATCH_MAX_WORKERS, max_distance_km=None):
+    '''
+    Gets the hourly air pollution series of one city between start and end.
+    Records are cached per location and day, and only the days missing from
+    the cache are downloaded. Long gaps are split into chunks that are
+    downloaded at the same time. Days that aren't over yet are never cached.
+    A city within max_distance_km of a location that is already cached
+    reuses the records of that location.
+
+    Parameters
+    ----------
+    city: string
+        city name
+    start: int
+        unix time of the start, or None for November 27, 2020
+    end: int
+        unix time of the end, or None for March 27, 2021
+        (or for now if only start is given)
+    max_workers: int
+        maximum number of chunks downloaded at the same time
+    max_distance_km: float
+        distance within which cached locations are reused,
+        or None for NEARBY_DISTANCE_KM
+
+    Returns
+    -------
+    String stating that the city name is invalid or the dates are reversed
+    OR
+    dt: numpy array
+        unix timestamps
+    values: numpy array
+        component values
+    '''
+    import numpy as np
+    start, end = get_history_range(start, end)
+    if start > end:
+        return "Start date is after end date."
+    try:
+        coordinates = geocode_city(city)
+    except ApiError as error:
+        return f"Could not get air pollution data for {city}: {error}"
+    if coordinates is None:
+        return f"Invalid city name: {city}."
+    if max_distance_km is None:
+        max_distance_km = NEARBY_DISTANCE_KM
+    location, lat, lon = POLLUTION_DAYS.find_location(coordinates[0], coordinates[1], max_distance_km)
+    first_day = int(start) // DAY_SECONDS
+    last_day = int(end) // DAY_SECONDS
+    days = POLLUTION_DAYS.load(location, first_day, last_day)
+    missing = [day for day in range(first_day, last_day + 1) if day not in days]
+    METRICS.count('cache_requests', last_day - first_day + 1 - len(missing), cache='pollution_days', result='hit')
+    METRICS.count('cache_requests', len(missing), cache='pollution_days', result='miss')
+    if missing:
+        chunks = split_into_chunks(missing)
+        fetched = {}
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+            futures = [executor.submit(fetch_history_days, lat, lon, *chunk) for chunk in chunks]
+            for future in futures:
+                try:
+                    fetched.update(future.result())
+                except ApiError as error:
+                    errors.append(error)
+        today = int(time.time()) // DAY_SECONDS
+        POLLUTION_DAYS.save(location, {day: arrays for day, arrays in fetched.items() if day < today})
+        if errors:
+            return f"Could not get air pollution data for {city}: {errors[0]}"
+        days.update(fetched)
+    ordered = [days[day] for day in range(first_day, last_day + 1)]
+    if ordered == []:
+        return f"No air pollution data for {city}."
+    dt = np.concatenate([arrays[0] for arrays in ordered])
+    values = np.concatenate([arrays[1] for arrays in ordered])
+    mask = (dt >= start) & (dt <= end)
+    dt, values = dt[mask], values[mask]
+    if len(dt) == 0:
+        return f"No air pollution data for {city}."
+    return dt, values
+
+def get_pollution_stats(city, start=None, end=None):
+    '''
+    Gets the mean, median, 95th percentile, maximum, and daily and weekly
+    means of every air pollution component for one city. Uses the cached
+    days, so no API call is made for days that were fetched before.
+
+    Parameters
+    ----------
+    city: string
+        city name
+    start: int
+        unix time of the start, or None for November 27, 2020
+    end: int
+        unix time of the end, or None for March 27, 2021
+
+    Returns
+    -------
+    String stating that the city name is invalid
+    OR
+    stats: dict
+        statistics from aggregate_pollution
+    '''
+    series = get_pollution_series(city, start, end)
+    if isinstance(series, str):
+        return series
+    with METRICS.timer('aggregation'):
+        return aggregate_pollution(*series)
+
+@timed('get_pollution_data')
+def get_pollution_data(city, start=None, end=None):
+    '''
+    Gets air pollution data for one city for November 27, 2020 - March 27, 2021,
+    or between start and end if they are given, and returns it. Checks cache
+    for the data. If no data is found in the cache, then the retrieved data is
+    stored in the cache.
+
+    Parameters
+    ----------
+    city: string
+        city name
+    start: int
+        unix time of the start, or None for November 27, 2020
+    end: int
+        unix time of the end, or None for March 27, 2021
+
+    Returns
+    -------
+    String stating that the city name is invalid
+    OR
+    city_dict: dict
+        dictionary of air pollution data
+    '''
+    start, end = get_history_range(start, end)
+    if start > end:
+        return "Start date is after end date."
+    if start == DEFAULT_HISTORY_START and end == DEFAULT_HISTORY_END:
+        cache_key = normalize_city_name(city)
+    else:
+        cache_key = f"{normalize_city_name(city)}|{start}|{end}"
+    cached = CITY_POLLUTION_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    else:
+        series = get_pollution_series(city, start, end)
+        if isinstance(series, str):
+            return series
+        dt, values = series
+        with METRICS.timer('aggregation'):
+            city_dict = dict(zip(POLLUTION_COMPONENTS, values.astype('float64').mean(axis=0).tolist()))
+        if end < time.time() - DAY_SECONDS:
+            CITY_POLLUTION_CACHE[cache_key] = city_dict
+        return city_dict
+
+def get_pollution_data_batch(cities, max_workers=BATCH_MAX_WORKERS, start=None, end=None):
+    '''
+    Gets air pollution data for many cities at once. Cities are fetched in
+    parallel on a bounded thread pool that shares one HTTP session and one
+    geocoder client. A failing city is recorded in the errors and does not
+    stop the rest of the batch.
+
+    Parameters
+    ----------
+    cities: list
+        city names
+    max_workers: int
+        maximum number of cities fetched at the same time
+    start: int
+        unix time of the start, or None for November 27, 2020
+    end: int
+        unix time of the end, or None for March 27, 2021
+
+    Returns
+    -------
+    results: dict
+        city name -> dictionary of air pollution data
+    errors: dict
+        city name -> error message
+    '''
+    results = {}
+    errors = {}
+    unique_cities = list(dict.fromkeys(cities))
+    if not unique_cities:
+        return results, errors
+    workers = max(1, min(max_workers, len(unique_cities)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(get_pollution_data, city, start, end): city for city in unique_cities}
+        for future in as_completed(futures):
+            city = futures[future]
+            try:
+                city_data = future.result()
+            except Exception as error:
+                errors[city] = f"Could not get data for {city}: {error}"
+                continue
+            if isinstance(city_data, str):
+                errors[city] = city_data
+            else:
+                results[city] = city_data
+    return results, errors
+
+def get_city_table(cities, start=None, end=None, max_workers=BATCH_MAX_WORKERS):
+    '''
+    Gets the mean air pollution of many cities as one ArrayTable, with one
+    row per city and one column per component. The cities are fetched in
+    parallel with get_pollution_data_batch.
+
+    Parameters
+    ----------
+    cities: list
+        city names
+    start: int
+        unix time of the start, or None for November 27, 2020
+    end: int
+        unix time of the end, or None for March 27, 2021
+    max_workers: int
+        maximum number of cities fetched at the same time
+
+    Returns
+    -------
+    city_table: ArrayTable
+        rows of the cities that worked, in the order they were given
+    errors: dict
+        city name -> error message
+    '''
+    results, errors = get_pollution_data_batch(cities, max_workers, start, end)
+    city_table = ArrayTable(POLLUTION_COMPONENTS)
+    for city in dict.fromkeys(cities):
+        if city in results:
+            city_table.add(city, results[city])
+    return city_table, errors
+
+def get_component_names(components):
+    '''
+    Converts component numbers (1-9) or names to component names.
+
+    Parameters
+    ----------
+    components: list
+        component numbers or names, or None for every component
+
+    Returns
+    -------
+    String stating that a component is invalid
+    OR
+    names: list
+        component names in POLLUTION_COMPONENTS
+    '''
+    if components is None:
+        return list(POLLUTION_COMPONENTS)
+    names = []
+    for component in components:
+        component = str(component).strip()
+        if component.isdigit() and 1 <= int(component) <= len(POLLUTION_COMPONENTS):
+            name = POLLUTION_COMPONENTS[int(component) - 1]
+        elif component.upper() in POLLUTION_COMPONENTS:
+            name = component.upper()
+        else:
+            return f"Invalid component: {component}."
+        if name not in names:
+            names.append(name)
+    return names
+
+def rank_values(values):
+    '''
+    Ranks the rows of a table in every column at once, with rank 1 for the
+    highest value. Equal values keep the order of the rows.
+
+    Parameters
+    ----------
+    values: numpy array
+        one row per city and one column per component
+
+    Returns
+    -------
+    ranks: numpy array
+        rank of each value within its column
+    '''
+    import numpy as np
+    order = np.argsort(-values, axis=0, kind='stable')
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(1, len(values) + 1)[:, None], axis=0)
+    return ranks
+
+@timed('compare_cities')
+def compare_cities(cities, components=None, start=None, end=None, max_workers=BATCH_MAX_WORKERS):
+    '''
+    Compares any number of cities on one or more air pollution components.
+    The cities are fetched in parallel, and the ranks of every city in every
+    component are computed together from the table of their means. The
+    overall ranking orders the cities by their average rank, so the most
+    polluted city comes first. A city that fails is reported in the errors
+    and is left out of the ranking.
+
+    Parameters
+    ----------
+    cities: list
+        city names
+    components: list
+        component numbers (1-9) or names, or None for every component
+    start: int
+        unix time of the start, or None for November 27, 2020
+    end: int
+        unix time of the end, or None for March 27, 2021
+    max_workers: int
+        maximum number of cities fetched at the same time
+
+    Returns
+    -------
+    String stating that a component is invalid
+    OR
+    comparison: dict
+        'components' compared, 'ranking' with the city, overall rank,
+        values and ranks of each city in ranked order, and 'errors' with
+        the error message of each city that failed
+    '''
+    import numpy as np
+    names = get_component_names(components)
+    if isinstance(names, str):
+        return names
+    city_table, errors = get_city_table(cities, start, end, max_workers)
+    comparison = {'components': names, 'ranking': [], 'errors': errors}
+    if len(city_table) == 0:
+        return comparison
+    with METRICS.timer('ranking'):
+        columns = [city_table.column_index[name] for name in names]
+        values = city_table.values[:, columns]
+        ranks = rank_values(values)
+        order = np.lexsort((np.arange(len(values)), ranks.mean(axis=1)))
+    for overall_rank, number in enumerate(order.tolist(), start=1):
+        comparison['ranking'].append({'city': city_table.keys[number], 'rank': overall_rank,
+                'values': dict(zip(names, values[number].tolist())),
+                'ranks': dict(zip(names, ranks[number].tolist()))})
+    return comparison
+
+def create_city_comparison_chart(comparison):
+    '''
+    Generates a bar chart of a comparison made by compare_cities, with the
+    cities in ranked order and one group of bars per component.
+
+    Parameters
+    ----------
+    comparison: dict
+        the comparison
+
+    Returns
+    -------
+    String stating that no city could be compared
+    OR
+    fig: Plotly figure
+        the bar chart
+    '''
+    import plotly.graph_objs as go
+    ranking = comparison['ranking']
+    if ranking == []:
+        errors = comparison['errors']
+        if len(errors) == 1:
+            return next(iter(errors.values()))
+        return "None of the cities could be compared."
+    xvals = [row['city'].title() for row in ranking]
+    bar_data = [go.Bar(x=xvals, y=[row['values'][name] for row in ranking], name=name)
+            for name in comparison['components']]
+    components = ', '.join(comparison['components'])
+    if len(xvals) == 1:
+        title = f"{components} of {xvals[0]}"
+    elif len(xvals) == 2:
+        title = f"Comparing {components} of {xvals[0]} and {xvals[1]}"
+    elif len(xvals) == 3:
+        title = f"Comparing {components} of {xvals[0]}, {xvals[1]}, and {xvals[2]}"
+    else:
+        title = f"Comparing {components} of {len(xvals)} cities"
+    layout = go.Layout(title=title, barmode='group')
+    with METRICS.timer('plot_render'):
+        fig = go.Figure(data=bar_data, layout=layout)
+    return fig
+
+@timed('create_city_pollution_bar_chart')
+def create_city_pollution_bar_chart(city1, component=None, *cities, start=None, end=None):
+    '''
+    Generates a bar chart of one or more cities.
+    If one city is selected, then the chart displays all 9 air air pollution components.
+    If more than one city is selected, then a component will need to be provided. The bar
+    chart displays the values for the selected component across the cities, most polluted
+    first. Cities that fail are left out of the chart.
+
+    Parameters
+    ----------
+    city1: string
+        first city
+    component: string
+        number corresponing to the selected component (1-9)
+    cities: strings
+        any number of other cities
+    start: int
+        unix time of the start, or None for November 27, 2020
+    end: int
+        unix time of the end, or None for March 27, 2021
+
+    Returns
+    -------
+    String stating that the city name is invalid
+    OR
+    fig: Plotly figure
+        the bar chart
+    '''
+    import plotly.graph_objs as go
+    if component == None:
+        city_table, errors = get_city_table([city1], start, end)
+        if city1 in errors:
+            return errors[city1]
+        xvals = POLLUTION_COMPONENTS[1:]
+        yvals = city_table.row(city1)[1:].tolist()
+        bar_data = go.Bar(x=xvals, y=yvals)
+        layout = go.Layout(title=f"Air Pollution of {city1.title()} in μg/m^3")
+        fig = go.Figure(data=bar_data, layout=layout)
+        return fig
+    comparison = compare_cities([city1, *cities], [component], start, end)
+    if isinstance(comparison, str):
+        return comparison
+    return create_city_comparison_chart(comparison)
+
+class MissingSnapshotError(Exception):
+    '''
+    Raised in offline mode when a page has never been downloaded.
+    '''
+
+def set_offline(offline=True):
+    '''
+    Turns offline mode on or off. In offline mode pages are only read from
+    the saved snapshots and nothing is downloaded. Offline mode can also be
+    turned on by setting the AIR_POLLUTION_OFFLINE environment variable to 1.
+
+    Parameters
+    ----------
+    offline: bool
+        True to turn offline mode on
+
+    Returns
+    -------
+    none
+    '''
+    global OFFLINE
+    OFFLINE = offline
+
+@timed('fetch_page')
+def fetch_page(url):
+    '''
+    Gets a web page, using the saved snapshot when the page hasn't changed.
+    The snapshot stores the ETag and Last-Modified headers of the page, which
+    are sent back so the server can answer 304 Not Modified instead of
+    sending the page again. If the download fails, the snapshot is used.
+
+    Parameters
+    ----------
+    url: string
+        page url
+
+    Returns
+    -------
+    html: string
+        the page
+    content_hash: string
+        hash of the page
+    '''
+    snapshot = PAGE_CACHE.get(url)
+    if OFFLINE:
+        if snapshot is None:
+            raise MissingSnapshotError(f"No saved snapshot of {url} to use in offline mode.")
+        return snapshot['text'], snapshot['hash']
+    headers = {}
+    if snapshot is not None:
+        if snapshot.get('etag'):
+            headers['If-None-Match'] = snapshot['etag']
+        if snapshot.get('last_modified'):
+            headers['If-Modified-Since'] = snapshot['last_modified']
+    try:
+        response = SCHEDULER.call('wikipedia', lambda: get_http_session().get(url, headers=headers, timeout=30), key=url)
+    except Exception:
+        if snapshot is None:
+            raise
+        return snapshot['text'], snapshot['hash']
+    if response.status_code == 304 and snapshot is not None:
+        return snapshot['text'], snapshot['hash']
+    if response.status_code != 200:
+        if snapshot is not None:
+            return snapshot['text'], snapshot['hash']
+        response.raise_for_status()
+    text = response.text
+    snapshot = {'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'text': text,
+            'hash': hashlib.sha256(text.encode('utf-8')).hexdigest()}
+    PAGE_CACHE[url] = snapshot
+    return text, snapshot['hash']
+
+def parse_page(url, parser):
+    '''
+    Gets a web page and parses it, reusing the saved parsed form when the
+    page hasn't changed, so BeautifulSoup only runs on new pages.
+
+    Parameters
+    ----------
+    url: string
+        page url
+    parser: function
+        function that takes the html and returns JSON serializable data
+
+    Returns
+    -------
+    parsed: the data returned by the parser
+    content_hash: string
+        hash of the page
+    '''
+    html, content_hash = fetch_page(url)
+    key = f"{parser.__name__}:{content_hash}"
+    parsed = PARSED_PAGE_CACHE.get(key)
+    if parsed is None:
+        with METRICS.timer('html_parse'):
+            parsed = parser(html)
+        PARSED_PAGE_CACHE[key] = parsed
+    return parsed, content_hash
+
+def parse_country_codes(html):
+    '''
+    Parses country three-letter country codes from the Wikipedia page.
+
+    Parameters
+    ----------
+    html: string
+        html of the ISO 3166-1 alpha-3 page
+
+    Returns
+    -------
+    country_code_dict: dict
+        dictionary with country names and corresponding codes
+    '''
+    from bs4 import BeautifulSoup
+
+    country_code_dict = {}
+    soup = BeautifulSoup(html, "html.parser")
+    list_items = soup.find(class_='plainlist')
+    for item in list_items.find_all('li'):
+        code_name = item.text
+        code = code_name[0:3]
+        name = code_name[5:]
+        country_code_dict[name] = code
+    return country_code_dict
+
+def create_country_code_dict():
+    '''
+    Scrapes country three-letter country codeds from Wikipedia
+    Parameters
+    ----------
+    none
+
+    Returns
+    -------
+    country_code_dict: dict
+        dictionary with country names and corresponding codes
+    '''
+    return parse_page(COUNTRY_CODES_URL, parse_country_codes)[0]
+
+def parse_alt_country_names(html):
+    '''
+    Parses alternative country names and codes from the Wikipedia page.
+
+    Parameters
+    ----------
+    html: string
+        html of the list of alternative country names
+
+    Returns
+    -------
+    alt_names_codes_dict: dict
+        dictionay containing official country name, alternative names, and code
+    '''
+    from bs4 import BeautifulSoup
+
+    alt_names_codes_dict = {}
+    soup = BeautifulSoup(html, 'html.parser')
+    tables = soup.find_all(class_ = "wikitable")
+    for table in tables:
+        for row in table.find_all('tr')[1:]:
+            cells = row.find_all('td')
+            code = cells[0].text.strip()
+            name = cells[1].text.strip()
+            alt_name = cells[2].text.strip()
+            simple_name = re.sub(r"\([^()]*\)", "", name)
+            simple_alt_name = re.sub(r"\([^()]*\)", "", alt_name) 
+            alt_name_code = {}
+            alt_name_code['code'] = code
+            alt_name_code['alt_names'] = simple_alt_name.strip()
+            alt_names_codes_dict[simple_name.strip()] = alt_name_code
+    return alt_names_codes_dict
+
+def get_alt_country_names_dict():
+    '''
+    Scrapes alternative country names and codes from Wikipedia,
+    using the saved snapshot when the page hasn't changed.
+
+    Parameters
+    ----------
+    none
+
+    Returns
+    -------
+    alt_names_codes_dict: dict
+        dictionay containing official country name, alternative names, and code
+    '''
+    return parse_page(ALT_COUNTRY_NAMES_URL, parse_alt_country_names)[0]
+
+_DB_LOCAL = threading.local()
+_TABLES = {}
+_TABLES_LOCK = threading.Lock()
+
+def get_connection():
+    '''
+    Returns a long-lived connection to the database. Each thread gets its
+    own connection, which is opened on first use and then reused.
+
+    Parameters
+    ----------
+    none
+
+    Returns
+    -------
+    connection: sqlite3 connection
+        connection to the database
+    '''
+    connection = getattr(_DB_LOCAL, 'connection', None)
+    if connection is None or _DB_LOCAL.pid != os.getpid():
+        connection = sqlite3.connect(DATABASE_FILENAME)
+        _DB_LOCAL.connection = connection
+        _DB_LOCAL.pid = os.getpid()
+    return connection
+
+def get_data_version():
+    '''
+    Returns the version of the data in the database, which is the hash of
+    the sources it was last built from.
+
+    Parameters
+    ----------
+    none
+
+    Returns
+    -------
+    version: string
+        data version, or None if the database hasn't been built
+    '''
+    cursor = get_connection().cursor()
+    try:
+        cursor.execute("SELECT value FROM build_info WHERE key='sources_hash'")
+    except sqlite3.OperationalError:
+        return None
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+@functools.lru_cache(maxsize=None)
+def get_region_dict():
+    '''
+    Returns the continent of every two-letter country code, from the
+    continent lists that come with the pygal world maps.
+
+    Parameters
+    ----------
+    none
+
+    Returns
+    -------
+    region_dict: dict
+        lowercase two-letter code -> region in REGIONS
+    '''
+    from pygal_maps_world import i18n
+    region_dict = {}
+    for region in REGIONS:
+        for alpha_2 in i18n.SUPRANATIONAL.get(region, []):
+            region_dict.setdefault(alpha_2, region)
+    return region_dict
+
+def get_country_info(code):
+    '''
+    Looks up the two-letter code, name and region of a three-letter country code.
+
+    Parameters
+    ----------
+    code: string
+        three-letter country code
+
+    Returns
+    -------
+    (code, alpha_2, name, region) tuple, with alpha_2, name and region None
+    for codes that aren't countries, such as regions
+    '''
+    import pycountry
+    country = pycountry.countries.get(alpha_3=code.strip())
+    if country is None:
+        return (code, None, None, None)
+    alpha_2 = country.alpha_2.lower()
+    return (code, alpha_2, country.name, get_region_dict().get(alpha_2))
+
+def get_sources_hash(csv_filenames, page_hashes):
+    '''
+    Hashes the contents of the csv files and the scraped Wikipedia pages.
+
+    Parameters
+    ----------
+    csv_filenames: list
+        paths of the csv files, or the path of one csv file
+    page_hashes: list
+        hashes of the scraped pages
+
+    Returns
+    -------
+    sources_hash: string
+        hex digest of the sources
+    '''
+    if isinstance(csv_filenames, str):
+        csv_filenames = [csv_filenames]
+    digest = hashlib.sha256()
+    for csv_filename in csv_filenames:
+        digest.update(os.path.basename(csv_filename).encode('utf-8'))
+        with open(csv_filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 16), b''):
+                digest.update(chunk)
+    for page_hash in page_hashes:
+        digest.update(page_hash.encode('utf-8'))
+    return digest.hexdigest()
+
+def create_tables(cursor):
+    '''
+    Creates the database tables if they don't exist. Databases made by older
+    versions, which had no keys and could hold duplicate rows, are dropped
+    and created again.
+
+    Parameters
+    ----------
+    cursor: sqlite3 cursor
+        cursor of the database connection
+
+    Returns
+    -------
+    none
+    '''
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        cursor.execute("DROP TABLE IF EXISTS air_pollution")
+        cursor.execute("DROP TABLE IF EXISTS emissions")
+        cursor.execute("DROP TABLE IF EXISTS build_info")
+        cursor.execute("DROP TABLE IF EXISTS series")
+        cursor.execute("DROP TABLE IF EXISTS country_names")
+        cursor.execute("DROP TABLE IF EXISTS countries")
+        cursor.execute("DROP TABLE IF EXISTS series_totals")
+        cursor.execute("DROP TABLE IF EXISTS series_ranks")
+        cursor.execute("DROP TABLE IF EXISTS series_changes")
+        cursor.execute("DROP TABLE IF EXISTS indicators")
+        cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    cursor.execute("CREATE TABLE IF NOT EXISTS air_pollution (country CHAR(30), country_code CHAR(3) PRIMARY KEY, "
+            + "'1990' REAL, '2005' REAL, '2017' REAL)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS emissions (country CHAR(30) PRIMARY KEY, country_code CHAR(3), "
+            + "'1990' REAL, '2005' REAL, '2017' REAL)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS build_info (key TEXT PRIMARY KEY, value TEXT)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS series (indicator TEXT, country_code CHAR(3), year INTEGER, value REAL, "
+            + "PRIMARY KEY (indicator, country_code, year)) WITHOUT ROWID")
+    cursor.execute("CREATE INDEX IF NOT EXISTS series_year ON series (indicator, year)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS series_country_code ON series (country_code)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS emissions_country_code ON emissions (country_code)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS country_names (name_key TEXT PRIMARY KEY, country_code CHAR(3)) WITHOUT ROWID")
+    cursor.execute("CREATE TABLE IF NOT EXISTS countries (country_code CHAR(3) PRIMARY KEY, alpha_2 CHAR(2), name TEXT, region TEXT)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS series_totals (indicator TEXT, region TEXT, year INTEGER, total REAL, "
+            + "mean REAL, countries INTEGER, PRIMARY KEY (indicator, region, year)) WITHOUT ROWID")
+    cursor.execute("CREATE TABLE IF NOT EXISTS series_ranks (indicator TEXT, year INTEGER, country_code CHAR(3), "
+            + "value REAL, rank INTEGER, percentile REAL, PRIMARY KEY (indicator, year, country_code)) WITHOUT ROWID")
+    cursor.execute("CREATE INDEX IF NOT EXISTS series_ranks_rank ON series_ranks (indicator, year, rank)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS series_changes (indicator TEXT, country_code CHAR(3), first_year INTEGER, "
+            + "last_year INTEGER, first_value REAL, last_value REAL, change REAL, percent_change REAL, "
+            + "PRIMARY KEY (indicator, country_code)) WITHOUT ROWID")
+    cursor.execute("CREATE INDEX IF NOT EXISTS series_changes_change ON series_changes (indicator, change)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS indicators (indicator TEXT PRIMARY KEY, name TEXT, source TEXT)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS series_changes_percent_change ON series_changes (indicator, percent_change)")
+
+HEADER_NAMES = {
+    'name': ('Country Name', 'Country'),
+    'code': ('Country Code', 'Country ISO3'),
+    'indicator': ('Indicator Code', 'Series Code'),
+    'indicator_name': ('Indicator Name', 'Series Name'),
+}
+
+def parse_year_header(name):
+    '''
+    Returns the year of a column header such as 1990 or 1990 [YR1990], or
+    None for other headers.
+    '''
+    match = re.fullmatch(r'(\d{4})(?: \[YR\d{4}\])?', name.strip())
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def detect_csv_layout(csv_filename, max_lines=50):
+    '''
+    Finds the header row of a World Development Indicators csv file, from
+    the bulk download or from DataBank, and the columns of the country,
+    the indicator and every year.
+
+    Parameters
+    ----------
+    csv_filename: string
+        path of the csv file
+    max_lines: int
+        number of lines searched for the header
+
+    Returns
+    -------
+    layout: dict
+        'offset' of the first data line in bytes, the column numbers of
+        'name', 'code', 'indicator' and 'indicator_name', and 'years' with
+        a (column, year) pair for every year column, or None if the file
+        has no such header
+    '''
+    with open(csv_filename, 'rb') as file:
+        for line_number in range(max_lines):
+            line = file.readline()
+            if not line:
+                return None
+            row = next(csv.reader([line.decode('utf-8-sig', errors='replace')]), [])
+            headers = [name.strip() for name in row]
+            layout = {'offset': file.tell()}
+            for key, names in HEADER_NAMES.items():
+                layout[key] = next((headers.index(name) for name in names if name in headers), None)
+            layout['years'] = [(index, parse_year_header(name)) for index, name in enumerate(headers)
+                    if parse_year_header(name) is not None]
+            if layout['code'] is not None and layout['indicator'] is not None and layout['years']:
+                return layout
+    return None
+
+def read_csv_lines(file, end):
+    '''
+    Yields the decoded lines of a binary file from its current position
+    until the line that starts at or after end.
+    '''
+    while file.tell() < end:
+        line = file.readline()
+        if not line:
+            break
+        yield line.decode('utf-8-sig', errors='replace')
+
+def split_csv_chunks(csv_filename, offset, chunk_bytes=INGEST_CHUNK_BYTES):
+    '''
+    Splits the data lines of a csv file into byte ranges of about
+    chunk_bytes that start and end on line boundaries.
+
+    Parameters
+    ----------
+    csv_filename: string
+        path of the csv file
+    offset: int
+        position of the first data line
+    chunk_bytes: int
+        size of a chunk
+
+    Returns
+    -------
+    chunks: list
+        (start, end) byte ranges
+    '''
+    size = os.path.getsize(csv_filename)
+    chunks = []
+    with open(csv_filename, 'rb') as file:
+        start = offset
+        while start < size:
+            file.seek(min(start + chunk_bytes, size))
+            file.readline()
+            end = min(file.tell(), size) if start + chunk_bytes < size else size
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def parse_csv_chunk(csv_filename, start, end, layout, indicators=None):
+    '''
+    Parses one byte range of a WDI csv file. Runs in the worker processes
+    of ingest_indicator_files.
+
+    Parameters
+    ----------
+    csv_filename: string
+        path of the csv file
+    start: int
+        position of the first line
+    end: int
+        position after the last line
+    layout: dict
+        layout found by detect_csv_layout
+    indicators: set
+        indicator codes to keep, or None to keep all of them
+
+    Returns
+    -------
+    rows: list
+        (indicator, country_code, year, value) tuples of every value
+    indicator_names: dict
+        indicator code -> indicator name
+    '''
+    code_column = layout['code']
+    indicator_column = layout['indicator']
+    name_column = layout['indicator_name']
+    rows = []
+    indicator_names = {}
+    with open(csv_filename, 'rb') as file:
+        file.seek(start)
+        for row in csv.reader(read_csv_lines(file, end)):
+            if len(row) <= max(code_column, indicator_column):
+                continue
+            indicator = row[indicator_column].strip()
+            code = row[code_column].strip()
+            if indicator == '' or code == '' or (indicators is not None and indicator not in indicators):
+                continue
+            if name_column is not None and name_column < len(row):
+                indicator_names[indicator] = row[name_column].strip()
+            for index, year in layout['years']:
+                if index < len(row) and row[index] != '':
+                    value = parse_number(row[index])
+                    if value is not None:
+                        rows.append((indicator, code, year, value))
+    return rows, indicator_names
+
+def read_air_pollution_rows(csv_filename):
+    '''
+    Reads the air pollution csv file and yields one row per country.
+
+    Parameters
+    ----------
+    csv_filename: string
+        path of the air pollution csv file
+
+    Returns
+    -------
+    generator of (country, country_code, 1990, 2005, 2017) tuples
+    '''
+    layout = detect_csv_layout(csv_filename)
+    if layout is None:
+        return
+    year_columns = dict((year, index) for index, year in layout['years'])
+    columns = [year_columns.get(LEGACY_YEARS[number]) for number in sorted(LEGACY_YEARS)]
+    with open(csv_filename, 'rb') as file:
+        file.seek(layout['offset'])
+        for row in csv.reader(read_csv_lines(file, os.path.getsize(csv_filename))):
+            if len(row) <= max(layout['name'], layout['code']):
+                continue
+            values = [parse_number(row[index]) if index is not None and index < len(row) else None for index in columns]
+            yield (row[layout['name']], row[layout['code']], *values)
+
+def get_indicator_filenames():
+    '''
+    Returns the csv files loaded into the series table: the air pollution
+    csv file and every csv file in the wdi folder.
+
+    Parameters
+    ----------
+    none
+
+    Returns
+    -------
+    filenames: list
+        paths of the csv files
+    '''
+    filenames = [AIR_POLLUTION_CSV_FILENAME]
+    if os.path.isdir(WDI_DIRECTORY):
+        filenames.extend(os.path.join(WDI_DIRECTORY, name) for name in sorted(os.listdir(WDI_DIRECTORY))
+                if name.lower().endswith('.csv'))
+    return filenames
+
+def ingest_indicator_files(cursor, csv_filenames, indicators=None, max_workers=None, chunk_bytes=INGEST_CHUNK_BYTES):
+    '''
+    Loads any number of WDI csv files into the series table. Each file's
+    header is found with detect_csv_layout, so files from the bulk download
+    and from DataBank both work, and files without a WDI header (such as
+    the metadata files) are skipped. The files are split into chunks that
+    are parsed in parallel worker processes. The rows are written in one
+    batch per chunk, in the order of the files, and only a few chunks are
+    held in memory at a time.
+
+    Parameters
+    ----------
+    cursor: sqlite3 cursor
+        cursor of the database connection
+    csv_filenames: list
+        paths of the csv files
+    indicators: set
+        indicator codes to keep, or None to keep all of them
+    max_workers: int
+        number of worker processes, or None for one per CPU
+    chunk_bytes: int
+        size of a chunk
+
+    Returns
+    -------
+    indicator_names: dict
+        indicator code -> indicator name of every indicator loaded
+    '''
+    query = "INSERT OR REPLACE INTO series (indicator, country_code, year, value) VALUES(?, ?, ?, ?)"
+    jobs = []
+    sources = {}
+    for csv_filename in csv_filenames:
+        layout = detect_csv_layout(csv_filename)
+        if layout is None:
+            continue
+        for start, end in split_csv_chunks(csv_filename, layout['offset'], chunk_bytes):
+            jobs.append((csv_filename, start, end, layout, indicators))
+    indicator_names = {}
+
+    def store(csv_filename, result):
+        rows, names = result
+        write_rows(cursor, 'series', query, rows)
+        for indicator, name in names.items():
+            indicator_names[indicator] = name
+            sources[indicator] = os.path.basename(csv_filename)
+
+    with METRICS.timer('ingest'):
+        if len(jobs) <= 1:
+            for job in jobs:
+                store(job[0], parse_csv_chunk(*job))
+        else:
+            workers = max_workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = []
+                for job in jobs:
+                    pending.append((job[0], executor.submit(parse_csv_chunk, *job)))
+                    if len(pending) > workers:
+                        csv_filename, future = pending.pop(0)
+                        store(csv_filename, future.result())
+                for csv_filename, future in pending:
+                    store(csv_filename, future.result())
+    write_rows(cursor, 'indicators', "INSERT OR REPLACE INTO indicators (indicator, name, source) VALUES(?, ?, ?)",
+            [(indicator, name, sources[indicator]) for indicator, name in indicator_names.items()])
+    return indicator_names
+
+def update_derived_indicators(cursor):
+    '''
+    Adds the indicators in DERIVED_INDICATORS to the series table, such as
+    CO2 emissions per person, by joining two indicators on country and year.
+    Nothing is added when one of the two indicators hasn't been loaded.
+
+    Parameters
+    ----------
+    cursor: sqlite3 cursor
+        cursor of the database connection
+
+    Returns
+    -------
+    none
+    '''
+    for indicator, (numerator, denominator, scale) in DERIVED_INDICATORS.items():
+        cursor.execute("DELETE FROM series WHERE indicator=?", (indicator,))
+        cursor.execute("INSERT INTO series (indicator, country_code, year, value) "
+                + "SELECT ?, top.country_code, top.year, top.value * ? / bottom.value "
+                + "FROM series AS top JOIN series AS bottom USING (country_code, year) "
+                + "WHERE top.indicator=? AND bottom.indicator=? AND bottom.value > 0",
+                (indicator, scale, numerator, denominator))
+        METRICS.count('db_rows_written', max(cursor.rowcount, 0), table='series')
+
+def parse_number(text):
+    '''
+    Converts a number scraped from Wikipedia, such as "1,234.5", to a float.
+
+    Parameters
+    ----------
+    text: string
+        scraped number
+
+    Returns
+    -------
+    value: float
+        the number, or None if the text isn't a number
+    '''
+    try:
+        return float(text.replace(',', ''))
+    except (AttributeError, ValueError):
+        return None
+
+def scrape_co2_emissions(html):
+    '''
+    Parses the CO2 emissions per country table from the Wikipedia page.
+
+    Parameters
+    ----------
+    html: string
+        html of the CO2 emissions page
+
+    Returns
+    -------
+    emissions: list
+        (country, 1990, 2005, 2017) tuples, with the emissions as floats
+    '''
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    table = soup.find('table', class_='wikitable')
+    emissions = []
+    rows = table.find_all('tr')[5:]
+    for row in rows:
+        cells = row.find_all('td')
+        emissions.append((cells[0].text.strip(), parse_number(cells[1].text.strip()),
+                parse_number(cells[2].text.strip()), parse_number(cells[3].text.strip())))
+    return emissions
+
+def normalize_country_name(name):
+    '''
+    Normalizes a country name so different spellings of the same name
+    compare equal. Removes accents, text in parentheses, punctuation and
+    a leading "the", and lowercases the rest.
+
+    Parameters
+    ----------
+    name: string
+        country name
+
+    Returns
+    -------
+    key: string
+        normalized name
+    '''
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    name = re.sub(r"\([^()]*\)|\[[^\[\]]*\]", " ", name.lower())
+    name = name.replace('&', ' and ')
+    name = re.sub(r"[^a-z0-9]+", " ", name).strip()
+    if name.startswith('the '):
+        name = name[4:]
+    return name
+
+class CountryResolver:
+    '''
+    Resolves country names, such as the ones scraped from the emissions page,
+    to three-letter country codes. The exact name, alias and token indexes
+    are built once. A name is looked up in this order: the fixed overrides,
+    the exact names, the aliases, and finally fuzzy matching. Fuzzy matching
+    only scores the names that share a word or a three letter prefix with
+    the name being resolved, and the best score wins, with ties broken by
+    code, so the result doesn't depend on dictionary order. Results are
+    memoized.
+
+    Parameters
+    ----------
+    names: dict
+        exact country names -> codes, such as the air pollution table
+    country_code_dict: dict
+        country names -> codes from create_country_code_dict
+    alt_names_codes: dict
+        alternative country names from get_alt_country_names_dict
+    '''
+
+    def __init__(self, names=None, country_code_dict=None, alt_names_codes=None):
+        self.exact = {}
+        self.aliases = {}
+        self.fuzzy_names = {}
+        self.token_index = {}
+        self.prefix_index = {}
+        self._memo = {}
+        for name, code in (names or {}).items():
+            self._add(self.exact, name, code)
+        for name, code in (country_code_dict or {}).items():
+            self._add(self.exact, name, code)
+            key = normalize_country_name(name)
+            if key and code:
+                self.fuzzy_names.setdefault(key, code)
+        for name, entry in (alt_names_codes or {}).items():
+            self._add(self.aliases, name, entry['code'])
+            for alt_name in re.split(r"[,;]", entry['alt_names']):
+                self._add(self.aliases, alt_name, entry['code'])
+        for key in self.fuzzy_names:
+            for token in self._tokens(key):
+                self.token_index.setdefault(token, set()).add(key)
+            self.prefix_index.setdefault(key[:3], set()).add(key)
+
+    @staticmethod
+    def _add(index, name, code):
+        key = normalize_country_name(name)
+        if key and code:
+            index.setdefault(key, code.strip())
+
+    @staticmethod
+    def _tokens(key):
+        return {token for token in key.split() if token not in COUNTRY_NAME_STOPWORDS}
+
+    def name_index(self):
+        '''
+        Returns every normalized exact name and alias with its code,
+        exact names first.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        list of (name_key, code) tuples
+        '''
+        return list(self.exact.items()) + list(self.aliases.items())
+
+    def resolve(self, name):
+        '''
+        Resolves one country name to its three-letter code.
+
+        Parameters
+        ----------
+        name: string
+            country name
+
+        Returns
+        -------
+        code: string
+            three-letter country code, or None if no match was found
+        '''
+        if name in self._memo:
+            return self._memo[name]
+        code = self._resolve(name)
+        self._memo[name] = code
+        return code
+
+    def _resolve(self, name):
+        for override, code in COUNTRY_CODE_OVERRIDES.items():
+            if override in name:
+                return code
+        key = normalize_country_name(name)
+        if not key:
+            return None
+        if key in self.exact:
+            return self.exact[key]
+        if key in self.aliases:
+            return self.aliases[key]
+        tokens = self._tokens(key)
+        candidates = set(self.prefix_index.get(key[:3], ()))
+        for token in tokens:
+            candidates.update(self.token_index.get(token, ()))
+        from fuzzywuzzy import fuzz
+        best = None
+        for candidate in candidates:
+            similarity = fuzz.ratio(candidate, key)
+            contained = candidate in key or key in candidate
+            if similarity > 77 or contained:
+                score = (similarity > 77, similarity)
+                code = self.fuzzy_names[candidate]
+                if best is None or score > best[0] or (score == best[0] and code < best[1]):
+                    best = (score, code)
+        if best is None:
+            return None
+        return best[1]
+
+def write_rows(cursor, table, query, rows):
+    '''
+    Runs an insert query for many rows and counts the rows written.
+
+    Parameters
+    ----------
+    cursor: sqlite3 cursor
+        cursor of the database connection
+    table: string
+        table the rows are written to, used as the metrics label
+    query: string
+        the insert query
+    rows: iterable
+        parameters of each row
+
+    Returns
+    -------
+    none
+    '''
+    with METRICS.timer('sqlite_write'):
+        cursor.executemany(query, rows)
+    METRICS.count('db_rows_written', max(cursor.rowcount, 0), table=table)
+
+def update_summaries(cursor):
+    '''
+    Rebuilds the summary tables from the series table: totals and means of
+    every indicator in SUMMARY_INDICATORS per year for the world and each
+    region, the rank and percentile of every country per indicator and year,
+    and the change of every country between the years in CHANGE_YEARS. Only
+    countries are counted, not the regions and income groups of the World
+    Bank data.
+
+    Parameters
+    ----------
+    cursor: sqlite3 cursor
+        cursor of the database connection
+
+    Returns
+    -------
+    none
+    '''
+    indicators = ', '.join('?' * len(SUMMARY_INDICATORS))
+    with METRICS.timer('summaries'):
+        cursor.execute("DELETE FROM series_totals")
+        cursor.execute("INSERT INTO series_totals (indicator, region, year, total, mean, countries) "
+                + "SELECT indicator, ?, year, SUM(value), AVG(value), COUNT(*) FROM series JOIN countries USING (country_code) "
+                + f"WHERE indicator IN ({indicators}) AND countries.alpha_2 IS NOT NULL GROUP BY indicator, year",
+                (WORLD_REGION, *SUMMARY_INDICATORS))
+        METRICS.count('db_rows_written', max(cursor.rowcount, 0), table='series_totals')
+        cursor.execute("INSERT INTO series_totals (indicator, region, year, total, mean, countries) "
+                + "SELECT indicator, region, year, SUM(value), AVG(value), COUNT(*) FROM series JOIN countries USING (country_code) "
+                + f"WHERE indicator IN ({indicators}) AND countries.region IS NOT NULL GROUP BY indicator, region, year",
+                SUMMARY_INDICATORS)
+        METRICS.count('db_rows_written', max(cursor.rowcount, 0), table='series_totals')
+
+        cursor.execute("DELETE FROM series_ranks")
+        cursor.execute("INSERT INTO series_ranks (indicator, year, country_code, value, rank, percentile) "
+                + "SELECT indicator, year, country_code, value, "
+                + "RANK() OVER (PARTITION BY indicator, year ORDER BY value DESC), "
+                + "100.0 * PERCENT_RANK() OVER (PARTITION BY indicator, year ORDER BY value) "
+                + f"FROM series JOIN countries USING (country_code) WHERE indicator IN ({indicators}) "
+                + "AND countries.alpha_2 IS NOT NULL", SUMMARY_INDICATORS)
+        METRICS.count('db_rows_written', max(cursor.rowcount, 0), table='series_ranks')
+
+        first_year, last_year = CHANGE_YEARS
+        cursor.execute("DELETE FROM series_changes")
+        cursor.execute("INSERT INTO series_changes (indicator, country_code, first_year, last_year, first_value, "
+                + "last_value, change, percent_change) "
+                + "SELECT earlier.indicator, earlier.country_code, earlier.year, later.year, earlier.value, later.value, "
+                + "later.value - earlier.value, CASE WHEN earlier.value != 0 "
+                + "THEN 100.0 * (later.value - earlier.value) / earlier.value END "
+                + "FROM series AS earlier JOIN series AS later USING (indicator, country_code) "
+                + "JOIN countries USING (country_code) "
+                + f"WHERE earlier.indicator IN ({indicators}) AND earlier.year=? AND later.year=? "
+                + "AND countries.alpha_2 IS NOT NULL", (*SUMMARY_INDICATORS, first_year, last_year))
+        METRICS.count('db_rows_written', max(cursor.rowcount, 0), table='series_changes')
+
+@timed('create_database')
+def create_database(force=False):
+    '''
+    Creates database of CO2 emissions per country and air pollution per country.
+    Air pollution is from a local csv file.
+    Emissions is scraped from Wikipedia.
+    Codes for the each country in the emissions table are found.
+    The build is skipped when the csv files and the scraped pages are the same
+    as in the last build. Otherwise every table is emptied and filled again in
+    one transaction, so running it again never adds duplicates or keeps rows
+    of countries that are gone from the sources.
+
+    Parameters
+    ----------
+    force: bool
+        rebuild even if the sources haven't changed
+
+    Returns
+    -------
+    built: bool
+        True if the database was rebuilt, False if it was already up to date
+    '''
+    connection = get_connection()
+    cursor = connection.cursor()
+    create_tables(cursor)
+    connection.commit()
+
+    with METRICS.timer('scrape'):
+        emissions, co2_hash = parse_page(CO2_EMISSIONS_URL, scrape_co2_emissions)
+        country_code_dict, codes_hash = parse_page(COUNTRY_CODES_URL, parse_country_codes)
+        alt_names_codes, alt_names_hash = parse_page(ALT_COUNTRY_NAMES_URL, parse_alt_country_names)
+    csv_filenames = get_indicator_filenames()
+    sources_hash = get_sources_hash(csv_filenames, [co2_hash, codes_hash, alt_names_hash])
+    cursor.execute("SELECT value FROM build_info WHERE key='sources_hash'")
+    stored_hash = cursor.fetchone()
+    if not force and stored_hash is not None and stored_hash[0] == sources_hash:
+        return False
+
+    with connection:
+        ### add air pollution per country to database ###
+        # the tables are emptied first, so countries dropped or renamed in the sources don't stay behind
+        cursor.execute("DELETE FROM air_pollution")
+        cursor.execute("DELETE FROM emissions")
+        query = ("INSERT INTO air_pollution (country, country_code, '1990', '2005', '2017') VALUES(?, ?, ?, ?, ?) "
+                + "ON CONFLICT(country_code) DO UPDATE SET country=excluded.country, '1990'=excluded.'1990', "
+                + "'2005'=excluded.'2005', '2017'=excluded.'2017'")
+        write_rows(cursor, 'air_pollution', query, read_air_pollution_rows(AIR_POLLUTION_CSV_FILENAME))
+
+        ### add CO2 data per country to database ###
+        cursor.execute("SELECT country, country_code FROM air_pollution")
+        with METRICS.timer('country_resolution'):
+            resolver = CountryResolver(dict(cursor.fetchall()), country_code_dict, alt_names_codes)
+            emission_rows = []
+            for country, e_1990, e_2005, e_2017 in emissions:
+                code = resolver.resolve(country)
+                emission_rows.append((country, code, e_1990, e_2005, e_2017))
+        query = ("INSERT INTO emissions (country, country_code, '1990', '2005', '2017') VALUES(?, ?, ?, ?, ?) "
+                + "ON CONFLICT(country) DO UPDATE SET country_code=excluded.country_code, '1990'=excluded.'1990', "
+                + "'2005'=excluded.'2005', '2017'=excluded.'2017'")
+        write_rows(cursor, 'emissions', query, emission_rows)
+
+        ### add every known name and alias to the country name index ###
+        cursor.execute("DELETE FROM country_names")
+        query = "INSERT OR IGNORE INTO country_names (name_key, country_code) VALUES(?, ?)"
+        write_rows(cursor, 'country_names', query, resolver.name_index())
+        write_rows(cursor, 'country_names', query, [(normalize_country_name(row[0]), row[1]) for row in emission_rows if row[1] is not None])
+        cursor.execute("SELECT country_code FROM air_pollution UNION SELECT country_code FROM emissions")
+        codes = [code for (code,) in cursor.fetchall() if code is not None]
+        write_rows(cursor, 'country_names', query, [(code.lower(), code) for code in codes])
+
+        ### add every year of every csv file and the CO2 emissions to the series table ###
+        # the secondary indexes are built once after the bulk load, which is faster than updating them per row
+        cursor.execute("DROP INDEX IF EXISTS series_year")
+        cursor.execute("DROP INDEX IF EXISTS series_country_code")
+        cursor.execute("DELETE FROM series")
+        ingest_indicator_files(cursor, csv_filenames)
+        query = "INSERT OR REPLACE INTO series (indicator, country_code, year, value) VALUES(?, ?, ?, ?)"
+        emission_series = []
+        for country, code, e_1990, e_2005, e_2017 in emission_rows:
+            if code is None:
+                continue
+            for year, value in ((1990, e_1990), (2005, e_2005), (2017, e_2017)):
+                if value is not None:
+                    emission_series.append((EMISSIONS_INDICATOR, code, year, value))
+        write_rows(cursor, 'series', query, emission_series)
+        update_derived_indicators(cursor)
+        create_tables(cursor)
+
+        ### store the two-letter code of every country once ###
+        cursor.execute("DELETE FROM countries")
+        cursor.execute("SELECT DISTINCT country_code FROM series")
+        series_codes = set(code for (code,) in cursor.fetchall())
+        write_rows(cursor, 'countries', "INSERT OR REPLACE INTO countries (country_code, alpha_2, name, region) VALUES(?, ?, ?, ?)",
+                [get_country_info(code) for code in sorted(series_codes.union(codes))])
+
+        ### precompute totals, ranks and changes ###
+        update_summaries(cursor)
+        cursor.execute("INSERT OR REPLACE INTO build_info (key, value) VALUES ('sources_hash', ?)", (sources_hash,))
+    return True
+
+def get_year_range(year):
+    '''
+    Turns a year argument into a (first, last) range. Accepts a single year,
+    a (first, last) pair, or the old menu numbers 1, 2 and 3 for 1990,
+    2005 and 2017.
+
+    Parameters
+    ----------
+    year: int or tuple
+        year, year range, or old menu number
+
+    Returns
+    -------
+    first, last: int
+        first and last year of the range
+    '''
+    if isinstance(year, (tuple, list)):
+        first, last = int(year[0]), int(year[1])
+    else:
+        first = last = LEGACY_YEARS.get(int(year), int(year))
+    if first > last:
+        first, last = last, first
+    return first, last
+
+def parse_year_range(text):
+    '''
+    Parses a year such as "2005" or a range such as "1990-2017".
+
+    Parameters
+    ----------
+    text: string
+        text entered by the user
+
+    Returns
+    -------
+    years: tuple
+        (first, last) years, or None if the text isn't a year or range
+    '''
+    match = re.fullmatch(r"\s*(\d{4})\s*(?:-\s*(\d{4})\s*)?", text)
+    if match is None:
+        return None
+    first = int(match.group(1))
+    last = int(match.group(2) or first)
+    return first, last
+
+def get_indicator_table(indicator):
+    '''
+    Returns the values of one indicator as an ArrayTable with one row per
+    country code and one column per year. The table is saved in the tables
+    folder the first time it is needed for the current data version, and is
+    memory mapped from there afterwards, also by the worker processes of
+    render_world_maps. It is kept in memory until the data version changes.
+
+    Parameters
+    ----------
+    indicator: string
+        indicator code, such as EMISSIONS_INDICATOR
+
+    Returns
+    -------
+    table: ArrayTable
+        the values, or an empty table if the database hasn't been built
+    '''
+    import numpy as np
+    version = get_data_version()
+    with _TABLES_LOCK:
+        cached = _TABLES.get(indicator)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        filename = None
+        table = None
+        if version is not None:
+            filename = os.path.join(TABLES_DIRECTORY, f"{indicator}_{version[:12]}.bin")
+            if os.path.exists(filename):
+                table = ArrayTable.load(filename)
+        if table is None:
+            cursor = get_connection().cursor()
+            with METRICS.timer('sqlite_query'):
+                cursor.execute("SELECT DISTINCT year FROM series WHERE indicator=? ORDER BY year", (indicator,))
+                years = [row[0] for row in cursor.fetchall()]
+                cursor.execute("SELECT DISTINCT country_code FROM series WHERE indicator=? ORDER BY country_code", (indicator,))
+                codes = [row[0] for row in cursor.fetchall()]
+                cursor.execute("SELECT country_code, year, value FROM series WHERE indicator=?", (indicator,))
+                points = cursor.fetchall()
+            METRICS.count('db_rows_read', len(points), table='series')
+            values = np.full((len(codes), len(years)), np.nan)
+            rows = {code: number for number, code in enumerate(codes)}
+            columns = {year: number for number, year in enumerate(years)}
+            for code, year, value in points:
+                values[rows[code], columns[year]] = value
+            table = ArrayTable(years, codes, values)
+            if filename is not None:
+                os.makedirs(TABLES_DIRECTORY, exist_ok=True)
+                for old_filename in os.listdir(TABLES_DIRECTORY):
+                    if old_filename.startswith(f"{indicator}_") and old_filename.endswith('.bin'):
+                        os.remove(os.path.join(TABLES_DIRECTORY, old_filename))
+                table.save(filename)
+        _TABLES[indicator] = (version, table)
+        return table
+
+def get_alpha_2_codes():
+    '''
+    Returns the lowercase two-letter code of every country that has one,
+    keyed by its three-letter code. Kept in memory until the data version
+    changes.
+
+    Parameters
+    ----------
+    none
+
+    Returns
+    -------
+    alpha_2_codes: dict
+        three-letter code -> two-letter code
+    '''
+    version = get_data_version()
+    with _TABLES_LOCK:
+        cached = _TABLES.get('alpha_2')
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT country_code, alpha_2 FROM countries WHERE alpha_2 IS NOT NULL")
+    alpha_2_codes = dict(cursor.fetchall())
+    with _TABLES_LOCK:
+        _TABLES['alpha_2'] = (version, alpha_2_codes)
+    return alpha_2_codes
+
+def get_year_columns(table, first, last):
+    '''
+    Returns a boolean mask of the year columns of a table that lie between
+    first and last.
+    '''
+    import numpy as np
+    years = np.array([int(column) for column in table.columns], dtype=np.int64)
+    return (years >= first) & (years <= last)
+
+def get_world_map_values(map_type, year):
+    '''
+    Reads the values shown on a world map: the value of every country with
+    data for a year, or its average over a range of years.
+
+    Parameters
+    ----------
+    map_type: int
+        1 for emissions, 2 for air pollution
+    year: int or tuple
+        a year such as 2005, a (first, last) range of years,
+        or 1 for 1990, 2 for 2005, or 3 for 2017
+
+    Returns
+    -------
+    years: string
+        the year or range of years, such as 2005 or 1990-2017
+    code_values_dict: dict
+        value of each country by its lowercase two-letter code
+    '''
+    import numpy as np
+    first, last = get_year_range(year)
+    if first == last:
+        years = str(first)
+    else:
+        years = f"{first}-{last}"
+    table = get_indicator_table(MAP_TYPES[map_type][0])
+    alpha_2_codes = get_alpha_2_codes()
+    with METRICS.timer('map_values'):
+        selected = table.values[:, get_year_columns(table, first, last)]
+        present = ~np.isnan(selected)
+        counts = present.sum(axis=1)
+        sums = np.where(present, selected, 0.0).sum(axis=1)
+        code_values_dict = {}
+        for number in np.flatnonzero(counts):
+            alpha_2 = alpha_2_codes.get(table.keys[number])
+            if alpha_2 is not None:
+                code_values_dict[alpha_2] = int(sums[number] / counts[number])
+    return years, code_values_dict
+
+@timed('build_world_map')
+def build_world_map(map_type, year):
+    '''
+    Builds a world map with either CO2 emissions or air pollution data
+    for a given year or range of years. For a range, each country shows
+    its average over the years in the range.
+
+    Parameters
+    ----------
+    map_type: int
+        1 for emissions, 2 for air pollution
+    year: int or tuple
+        a year such as 2005, a (first, last) range of years,
+        or 1 for 1990, 2 for 2005, or 3 for 2017
+
+    Returns
+    -------
+    String stating that there is no data for the year
+    OR
+    worldmap_chart: pygal World map
+        the map
+    '''
+    import pygal
+    years, code_values_dict = get_world_map_values(map_type, year)
+    if code_values_dict == {}:
+        return f"No data for {years}"
+    worldmap_chart = pygal.maps.world.World()
+    if map_type == 1:
+        worldmap_chart.title = f"CO2 Emissions by Country in {years}"
+        label = 'Mt CO2'
+    else:
+        worldmap_chart.title = f"Air Pollution by Country in {years}"
+        label = "Annual Exposure"
+    worldmap_chart.add(label, code_values_dict)
+    return worldmap_chart
+
+@timed('generate_world_map')
+def generate_world_map(map_type, year):
+    '''
+    Generates a world map with either CO2 emissions or air pollution data
+    for a given year or range of years and opens it in the browser.
+
+    Parameters
+    ----------
+    map_type: int
+        1 for emissions, 2 for air pollution
+    year: int or tuple
+        a year such as 2005, a (first, last) range of years,
+        or 1 for 1990, 2 for 2005, or 3 for 2017
+
+    Returns
+    -------
+    String stating that there is no data for the year
+    OR
+    none
+    '''
+    worldmap_chart = build_world_map(map_type, year)
+    if isinstance(worldmap_chart, str):
+        return worldmap_chart
+    with METRICS.timer('plot_render'):
+        worldmap_chart.render_in_browser()
+
+def render_world_map_file(map_type, year, filename, file_format='svg'):
+    '''
+    Renders one world map to an SVG or HTML file. Runs in the worker
+    processes of render_world_maps.
+
+    Parameters
+    ----------
+    map_type: int
+        1 for emissions, 2 for air pollution
+    year: int or tuple
+        year or (first, last) range of years of the map
+    filename: string
+        file to write
+    file_format: string
+        'svg' or 'html'
+
+    Returns
+    -------
+    filename: string
+        the file written, or None if there was no data for the year
+    '''
+    worldmap_chart = build_world_map(map_type, year)
+    if isinstance(worldmap_chart, str):
+        return None
+    svg = worldmap_chart.render(is_unicode=True)
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w', encoding='utf-8') as file:
+        if file_format == 'html':
+            file.write(f"<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\"><title>{worldmap_chart.title}</title></head>\n"
+                    + f"<body>\n{svg}\n</body>\n</html>\n")
+        else:
+            file.write(svg)
+    os.replace(temp_filename, filename)
+    return filename
+
+def render_world_maps(map_types=(1, 2), years=None, output_dir=MAPS_DIRECTORY, file_format='svg', max_workers=None):
+    '''
+    Renders world maps for every combination of map type and year to files,
+    using parallel worker processes. File names include the data version,
+    so maps that already exist for the current data are not rendered again.
+
+    Parameters
+    ----------
+    map_types: tuple
+        map types to render, 1 for emissions and 2 for air pollution
+    years: list
+        years to render, or None for every year with data
+    output_dir: string
+        directory the maps are written to
+    file_format: string
+        'svg' or 'html'
+    max_workers: int
+        number of worker processes, or None for one per CPU
+
+    Returns
+    -------
+    filenames: dict
+        (map_type, year) -> file of the map
+    '''
+    version = get_data_version()
+    if version is None:
+        return {}
+    os.makedirs(output_dir, exist_ok=True)
+    filenames = {}
+    jobs = []
+    for map_type in map_types:
+        indicator, name = MAP_TYPES[map_type]
+        # also saves the table file, so the worker processes only map it
+        table = get_indicator_table(indicator)
+        if years is None:
+            map_years = [int(column) for column in table.columns]
+        else:
+            map_years = [get_year_range(year)[0] for year in years]
+        for year in map_years:
+            filename = os.path.join(output_dir, f"{name}_{year}_{version[:12]}.{file_format}")
+            if os.path.exists(filename):
+                filenames[(map_type, year)] = filename
+            else:
+                jobs.append((map_type, year, filename))
+    if jobs:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(render_world_map_file, map_type, year, filename, file_format): (map_type, year)
+                    for map_type, year, filename in jobs}
+            for future in as_completed(futures):
+                filename = future.result()
+                if filename is not None:
+                    filenames[futures[future]] = filename
+    return filenames
+
+def find_country_code(country):
+    '''
+    Looks up the three-letter code of a country name, alternative name or
+    code entered by the user, using the indexed country name table.
+
+    Parameters
+    ----------
+    country: string
+        country name
+
+    Returns
+    -------
+    code: string
+        three-letter country code, or None if the name isn't known
+    '''
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT country_code FROM country_names WHERE name_key=?", (normalize_country_name(country),))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def get_country_series(country, graph_type, start_year=None, end_year=None):
+    '''
+    Reads the air pollution or emissions values of a country for every year
+    with data between start_year and end_year. A reversed range is swapped.
+
+    Parameters
+    ----------
+    country: string
+        country name
+    graph_type: string
+        1 for emissions, 2 for air pollution
+    start_year: int
+        first year, or None for the first year with data
+    end_year: int
+        last year, or None for the last year with data
+
+    Returns
+    -------
+    None if the country or graph type is invalid
+    OR
+    String stating that there is no data for the country
+    OR
+    series: dict
+        'country' name, 'code', 'title' of the data, and lists of 'years' and 'values'
+    '''
+    import numpy as np
+    if graph_type == '1':
+        table = 'emissions'
+        indicator = EMISSIONS_INDICATOR
+        title = "CO2 Emissions"
+    elif graph_type == '2':
+        table = 'air_pollution'
+        indicator = AIR_POLLUTION_INDICATOR
+        title = "Air Pollution"
+    else:
+        return None
+    start_year, end_year = get_year_range((0 if start_year is None else start_year,
+            9999 if end_year is None else end_year))
+    code = find_country_code(country)
+    if code is None:
+        return None
+    cursor = get_connection().cursor()
+    cursor.execute(f"SELECT country FROM {table} WHERE country_code=?", (code,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    indicator_table = get_indicator_table(indicator)
+    values = indicator_table.row(code)
+    if values is None:
+        return f"No data for {row[0]}"
+    selected = get_year_columns(indicator_table, start_year, end_year) & ~np.isnan(values)
+    if not selected.any():
+        return f"No data for {row[0]}"
+    years = [int(indicator_table.columns[number]) for number in np.flatnonzero(selected)]
+    return {'country': row[0], 'code': code, 'title': title,
+            'years': years, 'values': values[selected].tolist()}
+
+@timed('generate_line_graph')
+def generate_line_graph(country, graph_type, start_year=None, end_year=None):
+    '''
+    Generates a line graph based on air pollution or emissions for a given country.
+    Every year with data between start_year and end_year is plotted.
+
+    Parameters
+    ----------
+    country: string
+        country name
+    graph_type: string
+        1 for emissions, 2 for air pollution
+    start_year: int
+        first year to plot, or None for the first year with data
+    end_year: int
+        last year to plot, or None for the last year with data
+    
+    Returns
+    -------
+    String stating that there is no data for the country
+    OR
+    fig: Plotly figure
+        the line graph
+    '''
+    import plotly.graph_objs as go
+    series = get_country_series(country, graph_type, start_year, end_year)
+    if series is None or isinstance(series, str):
+        return series
+    xvals = [str(year) for year in series['years']]
+    yvals = series['values']
+    with METRICS.timer('plot_render'):
+        line_data = go.Scatter(x=xvals, y=yvals)
+        layout = go.Layout(title=f"{series['title']} for {series['country']} from {xvals[0]}-{xvals[-1]}")
+        fig = go.Figure(data=line_data, layout=layout)
+    return fig
+
+def get_indicator_code(map_type):
+    '''
+    Returns the indicator code of a map type, or the map type itself if it
+    is already an indicator code.
+    '''
+    if map_type in MAP_TYPES:
+        return MAP_TYPES[map_type][0]
+    return map_type
+
+def get_top_countries(map_type, year, limit=20, lowest=False):
+    '''
+    Returns the countries with the highest (or lowest) values of a year,
+    read from the precomputed ranks.
+
+    Parameters
+    ----------
+    map_type: int
+        1 for emissions, 2 for air pollution, or an indicator code such as CO2.PC
+    year: int
+        year such as 2005
+    limit: int
+        number of countries
+    lowest: bool
+        True for the countries with the lowest values
+
+    Returns
+    -------
+    countries: list
+        dictionaries with the 'rank', 'code', 'country' name, 'value' and
+        'percentile' of each country
+    '''
+    indicator = get_indicator_code(map_type)
+    order = 'DESC' if lowest else 'ASC'
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT series_ranks.rank, country_code, countries.name, series_ranks.value, series_ranks.percentile "
+            + "FROM series_ranks JOIN countries USING (country_code) WHERE indicator=? AND year=? "
+            + f"ORDER BY series_ranks.rank {order} LIMIT ?", (indicator, year, limit))
+    return [{'rank': rank, 'code': code, 'country': name, 'value': value, 'percentile': percentile}
+            for rank, code, name, value, percentile in cursor.fetchall()]
+
+def get_largest_changes(map_type, limit=20, fell=True, percent=False):
+    '''
+    Returns the countries whose values fell (or rose) the most between the
+    years in CHANGE_YEARS, read from the precomputed changes.
+
+    Parameters
+    ----------
+    map_type: int
+        1 for emissions, 2 for air pollution, or an indicator code such as CO2.PC
+    limit: int
+        number of countries
+    fell: bool
+        True for the largest falls, False for the largest rises
+    percent: bool
+        True to order by percent change instead of absolute change
+
+    Returns
+    -------
+    countries: list
+        dictionaries with the 'code', 'country' name, 'first_year',
+        'last_year', 'first_value', 'last_value', 'change' and
+        'percent_change' of each country
+    '''
+    indicator = get_indicator_code(map_type)
+    column = 'percent_change' if percent else 'change'
+    order = 'ASC' if fell else 'DESC'
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT country_code, countries.name, first_year, last_year, first_value, last_value, change, "
+            + "percent_change FROM series_changes JOIN countries USING (country_code) "
+            + f"WHERE indicator=? AND {column} IS NOT NULL ORDER BY {column} {order} LIMIT ?", (indicator, limit))
+    names = ['code', 'country', 'first_year', 'last_year', 'first_value', 'last_value', 'change', 'percent_change']
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+def get_totals(map_type, region=WORLD_REGION):
+    '''
+    Returns the precomputed total and mean of every year for the world or
+    one region.
+
+    Parameters
+    ----------
+    map_type: int
+        1 for emissions, 2 for air pollution, or an indicator code such as CO2.PC
+    region: string
+        WORLD_REGION or one of REGIONS
+
+    Returns
+    -------
+    totals: list
+        dictionaries with the 'year', 'total', 'mean' and number of
+        'countries' of each year
+    '''
+    indicator = get_indicator_code(map_type)
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT year, total, mean, countries FROM series_totals WHERE indicator=? AND region=? "
+            + "ORDER BY year", (indicator, region))
+    return [{'year': year, 'total': total, 'mean': mean, 'countries': countries}
+            for year, total, mean, countries in cursor.fetchall()]
+
+class HttpError(Exception):
+    '''
+    Error returned to a client of the local HTTP service.
+
+    Parameters
+    ----------
+    status: int
+        HTTP status code
+    message: string
+        error message
+    '''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+HTTP_REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+        405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+class RenderCache:
+    '''
+    In-memory cache of rendered responses of the local HTTP service. Entries
+    are removed when they are older than ttl seconds, and the least recently
+    used entries are removed once there are more than max_entries.
+
+    Parameters
+    ----------
+    max_entries: int
+        maximum number of responses kept
+    ttl: int
+        seconds a response is kept, or None to keep it until it is evicted
+    '''
+
+    def __init__(self, max_entries=RENDER_CACHE_MAX_ENTRIES, ttl=RENDER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        '''
+        Returns the cached response for key, or None if it is missing or
+        older than ttl.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            METRICS.count('cache_requests', cache='render', result='miss')
+            return None
+        if self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            METRICS.count('cache_requests', cache='render', result='expired')
+            return None
+        self.entries.move_to_end(key)
+        METRICS.count('cache_requests', cache='render', result='hit')
+        return entry[1]
+
+    def set(self, key, response):
+        '''
+        Stores a response, dropping the least recently used ones beyond
+        max_entries.
+        '''
+        self.entries[key] = (time.monotonic(), response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        '''
+        Drops every cached response.
+        '''
+        self.entries.clear()
+
+def get_query_value(query, name, default=None):
+    '''
+    Returns the last value of a query string parameter.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string, with a list of values for each name
+    name: string
+        parameter name
+    default: any
+        value returned if the parameter is missing
+
+    Returns
+    -------
+    value: string
+    '''
+    values = query.get(name)
+    if not values:
+        return default
+    return values[-1]
+
+def get_query_dates(query):
+    '''
+    Reads the start and end parameters of a request. An end date includes
+    the whole day.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    start: int
+        unix time, or None
+    end: int
+        unix time, or None
+    '''
+    dates = []
+    for name in ('start', 'end'):
+        value = get_query_value(query, name)
+        if value is None:
+            dates.append(None)
+            continue
+        try:
+            dates.append(parse_date(value, end_of_day=name == 'end'))
+        except argparse.ArgumentTypeError as error:
+            raise HttpError(400, str(error))
+    return dates[0], dates[1]
+
+def get_query_cities(query):
+    '''
+    Reads the cities of a request, given as city=...&city=... or as
+    cities=a;b;c.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    cities: list
+        city names
+    '''
+    cities = list(query.get('city', []))
+    for value in query.get('cities', []):
+        cities.extend(city for city in value.split(';') if city.strip())
+    if cities == []:
+        raise HttpError(400, "Enter at least one city with city=...")
+    return cities
+
+def get_query_components(query):
+    '''
+    Reads the components of a request, given as component=2&component=7 or
+    as component=2,7. The default is the AQI. Raises HttpError 400 for an
+    invalid component number.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    components: list
+        component names from POLLUTION_COMPONENTS
+    '''
+    components = []
+    for value in query.get('component', ['1']):
+        components.extend(value.split(','))
+    names = get_component_names(components)
+    if isinstance(names, str):
+        raise HttpError(400, names)
+    return names
+
+def get_query_map_type(query):
+    '''
+    Reads the type parameter of a request, emissions by default. Raises
+    HttpError 400 for any other value than emissions or air-pollution.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    map_type: string
+        'emissions' or 'air-pollution'
+    '''
+    map_type = get_query_value(query, 'type', 'emissions')
+    if map_type not in ('emissions', 'air-pollution'):
+        raise HttpError(400, f"Invalid type: {map_type}. Use emissions or air-pollution.")
+    return map_type
+
+def figure_to_html(fig):
+    '''
+    Renders a Plotly figure to a full HTML page that loads plotly.js from
+    the CDN, so responses stay small.
+
+    Parameters
+    ----------
+    fig: Plotly figure
+        the chart
+
+    Returns
+    -------
+    html: string
+        the page
+    '''
+    return fig.to_html(include_plotlyjs='cdn', full_html=True)
+
+def check_result(results):
+    '''
+    Turns the None or error string returned by a chart or data function into
+    an HttpError 404.
+
+    Parameters
+    ----------
+    results: any
+        what the function returned
+
+    Returns
+    -------
+    results: any
+        the same results, if they are not None or a string
+    '''
+    if results is None:
+        raise HttpError(404, "Invalid country name.")
+    if isinstance(results, str):
+        raise HttpError(404, results)
+    return results
+
+def serve_city(query):
+    '''
+    Serves /city: the statistics of one city as JSON. Raises HttpError 400
+    without a city or for an invalid date, and 404 when there is no data.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        'application/json'
+    body: string
+        statistics from get_pollution_stats
+    '''
+    city = get_query_value(query, 'city')
+    if city is None:
+        raise HttpError(400, "Enter a city with city=...")
+    start, end = get_query_dates(query)
+    return 'application/json', json.dumps(check_result(get_pollution_stats(city, start, end)))
+
+def serve_city_chart(query):
+    '''
+    Serves /city.html: the bar chart of one city. Raises HttpError 400
+    without a city or for an invalid date, and 404 when there is no data.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        HTML content type
+    body: string
+        HTML page with the chart
+    '''
+    city = get_query_value(query, 'city')
+    if city is None:
+        raise HttpError(400, "Enter a city with city=...")
+    start, end = get_query_dates(query)
+    fig = check_result(create_city_pollution_bar_chart(city, start=start, end=end))
+    return 'text/html; charset=utf-8', figure_to_html(fig)
+
+def serve_compare(query):
+    '''
+    Serves /compare: the cities of the request ranked by each component, as
+    JSON. Raises HttpError 400 without cities, or for an invalid component
+    or date.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        'application/json'
+    body: string
+        ranking from compare_cities
+    '''
+    cities = get_query_cities(query)
+    components = get_query_components(query)
+    start, end = get_query_dates(query)
+    return 'application/json', json.dumps(compare_cities(cities, components, start, end))
+
+def serve_compare_chart(query):
+    '''
+    Serves /compare.html: the comparison chart of the cities of the request.
+    Raises HttpError 400 without cities, or for an invalid component or
+    date, and 404 when no city has data.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        HTML content type
+    body: string
+        HTML page with the chart
+    '''
+    cities = get_query_cities(query)
+    components = get_query_components(query)
+    start, end = get_query_dates(query)
+    fig = check_result(create_city_comparison_chart(compare_cities(cities, components, start, end)))
+    return 'text/html; charset=utf-8', figure_to_html(fig)
+
+def get_query_country(query):
+    '''
+    Reads the country, type and years parameters of a request. Raises
+    HttpError 400 without a country, or for an invalid type or range of
+    years.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    country: string
+        country name
+    graph_type: string
+        '1' for emissions, '2' for air pollution
+    start_year, end_year: int
+        first and last year, or None for all years
+    '''
+    country = get_query_value(query, 'country')
+    if country is None:
+        raise HttpError(400, "Enter a country with country=...")
+    graph_type = '1' if get_query_map_type(query) == 'emissions' else '2'
+    years = get_query_value(query, 'years')
+    if years is None:
+        return country, graph_type, None, None
+    year_range = parse_year_range(years)
+    if year_range is None:
+        raise HttpError(400, f"Invalid range of years: {years}")
+    return country, graph_type, year_range[0], year_range[1]
+
+def serve_country(query):
+    '''
+    Serves /country: the yearly values of one country as JSON. Raises
+    HttpError 400 for bad parameters, and 404 for an unknown country or
+    when there is no data.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        'application/json'
+    body: string
+        series from get_country_series
+    '''
+    series = check_result(get_country_series(*get_query_country(query)))
+    return 'application/json', json.dumps(series)
+
+def serve_country_chart(query):
+    '''
+    Serves /country.html: the line graph of one country. Raises HttpError
+    400 for bad parameters, and 404 for an unknown country or when there is
+    no data.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        HTML content type
+    body: string
+        HTML page with the graph
+    '''
+    fig = check_result(generate_line_graph(*get_query_country(query)))
+    return 'text/html; charset=utf-8', figure_to_html(fig)
+
+def get_query_map(query):
+    '''
+    Reads the type and year parameters of a map request. Raises HttpError
+    400 for an invalid type, or a missing or invalid year.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    map_type: int
+        1 for emissions, 2 for air pollution
+    years: tuple
+        first and last year
+    '''
+    map_type = 1 if get_query_map_type(query) == 'emissions' else 2
+    year = get_query_value(query, 'year')
+    years = parse_year_range(year or '')
+    if years is None:
+        raise HttpError(400, "Enter a year such as 2005 or a range such as 1990-2017 with year=...")
+    return map_type, years
+
+def serve_map(query):
+    '''
+    Serves /map: the value of every country for a year or range of years,
+    as JSON. Raises HttpError 400 for bad parameters, and 404 when there is
+    no data for the years.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        'application/json'
+    body: string
+        'type', 'years' and 'values' keyed by country code
+    '''
+    map_type, years = get_query_map(query)
+    years, code_values_dict = get_world_map_values(map_type, years)
+    if code_values_dict == {}:
+        raise HttpError(404, f"No data for {years}")
+    return 'application/json', json.dumps({'type': MAP_TYPES[map_type][1], 'years': years, 'values': code_values_dict})
+
+def serve_map_chart(query):
+    '''
+    Serves /map.svg: the world map for a year or range of years. Raises
+    HttpError 400 for bad parameters, and 404 when there is no data for the
+    years.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        'image/svg+xml'
+    body: string
+        the map as SVG
+    '''
+    worldmap_chart = check_result(build_world_map(*get_query_map(query)))
+    with METRICS.timer('plot_render'):
+        return 'image/svg+xml', worldmap_chart.render(is_unicode=True)
+
+def get_query_number(query, name, default):
+    '''
+    Reads a whole number parameter of a request. Raises HttpError 400 if
+    the value is not a whole number.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+    name: string
+        parameter name
+    default: int
+        value returned if the parameter is missing
+
+    Returns
+    -------
+    number: int
+    '''
+    value = get_query_value(query, name)
+    if value is None:
+        return default
+    if not value.isdigit():
+        raise HttpError(400, f"Invalid {name}: {value}")
+    return int(value)
+
+def get_query_flag(query, name):
+    '''
+    Reads a yes/no parameter of a request. Missing, empty, 0 and false
+    mean no.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+    name: string
+        parameter name
+
+    Returns
+    -------
+    flag: bool
+    '''
+    return get_query_value(query, name, '0') not in ('', '0', 'false')
+
+def serve_rank(query):
+    '''
+    Serves /rank: the top or lowest countries of one year as JSON. Raises
+    HttpError 400 for an invalid type, a missing year or an invalid top.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        'application/json'
+    body: string
+        countries from get_top_countries
+    '''
+    map_type = 1 if get_query_map_type(query) == 'emissions' else 2
+    year = get_query_number(query, 'year', None)
+    if year is None:
+        raise HttpError(400, "Enter a year with year=...")
+    countries = get_top_countries(map_type, year, get_query_number(query, 'top', 20), get_query_flag(query, 'lowest'))
+    return 'application/json', json.dumps(countries)
+
+def serve_changes(query):
+    '''
+    Serves /changes: the countries whose values fell or rose the most, as
+    JSON. Raises HttpError 400 for an invalid type, direction or top.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        'application/json'
+    body: string
+        countries from get_largest_changes
+    '''
+    map_type = 1 if get_query_map_type(query) == 'emissions' else 2
+    direction = get_query_value(query, 'direction', 'fell')
+    if direction not in ('fell', 'rose'):
+        raise HttpError(400, f"Invalid direction: {direction}. Use fell or rose.")
+    countries = get_largest_changes(map_type, get_query_number(query, 'top', 20), direction == 'fell',
+            get_query_flag(query, 'percent'))
+    return 'application/json', json.dumps(countries)
+
+def serve_totals(query):
+    '''
+    Serves /totals: the yearly totals of the world or of one region, as
+    JSON. Raises HttpError 400 for an invalid type or region.
+
+    Parameters
+    ----------
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    content_type: string
+        'application/json'
+    body: string
+        totals from get_totals
+    '''
+    map_type = 1 if get_query_map_type(query) == 'emissions' else 2
+    region = get_query_value(query, 'region', WORLD_REGION)
+    if region != WORLD_REGION and region not in REGIONS:
+        raise HttpError(400, f"Invalid region: {region}")
+    return 'application/json', json.dumps(get_totals(map_type, region))
+
+SERVER_ROUTES = {
+    '/city': serve_city,
+    '/city.html': serve_city_chart,
+    '/compare': serve_compare,
+    '/compare.html': serve_compare_chart,
+    '/country': serve_country,
+    '/country.html': serve_country_chart,
+    '/map': serve_map,
+    '/map.svg': serve_map_chart,
+    '/rank': serve_rank,
+    '/changes': serve_changes,
+    '/totals': serve_totals,
+}
+
+class PollutionServer:
+    '''
+    Local HTTP service that serves city statistics, city comparisons,
+    country series and world maps as JSON, HTML or SVG. Requests are read
+    with asyncio, and the work runs on a small thread pool that shares the
+    pooled HTTP clients, the caches and one database connection per thread.
+    Responses are cached in memory, keyed on the path, the parameters and the
+    version of the data, and sent with an ETag so clients can revalidate
+    them with If-None-Match. Identical requests that arrive at the same time
+    share one render.
+
+    Parameters
+    ----------
+    host: string
+        address to listen on
+    port: int
+        port to listen on
+    max_workers: int
+        number of threads doing the work
+    '''
+
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, max_workers=SERVER_MAX_WORKERS):
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = RenderCache()
+        self.pending = {}
+
+    async def serve_forever(self):
+        '''
+        Listens on the host and port until the process is stopped.
+        '''
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"Serving on http://{self.host}:{self.port}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        '''
+        Reads the requests of one connection and answers each of them, until
+        the client closes it or asks for it to be closed. A route that fails
+        gets a 500 JSON error and the connection stays open.
+        '''
+        try:
             while True:
-                print("\n1. CO2 Emissions\n2. Air Pollution\n")
-                map_type = input('Enter the number corresponding to the data you wish to explore: ')
-                if int(map_type.strip()) not in range(1,3):
-                    print("\nInvalid selection\n")
-                else:
-                    print("\n1. 1990\n2. 2005\n3. 2017\n")
-                    year = input("\nEnter the number corresponding to the year you wish to explore: ")
-                    if int(year.strip()) not in range(1,4):
-                        print("\nInvalid selection")
-                    else:
-                        generate_world_map(int(map_type.strip()), int(year.strip()))
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
                         break
-        elif data_type.strip().lower() == 'exit':
-            exit()
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if len(parts) != 3:
+                    await self.send(writer, 400, 'text/plain; charset=utf-8', b"Bad request line\n", close=True)
+                    break
+                method, target, version = parts
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                try:
+                    status, content_type, body, etag = await self.respond(method, target, headers)
+                except Exception as error:
+                    status, etag = 500, None
+                    content_type = 'application/json'
+                    body = json.dumps({'error': f"{type(error).__name__}: {error}"}).encode()
+                await self.send(writer, status, content_type, body, etag, head=method == 'HEAD', close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer, status, content_type, body, etag=None, head=False, close=False):
+        '''
+        Writes one response. 304 responses and responses to HEAD requests
+        have no body.
+        '''
+        lines = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}"]
+        if status != 304:
+            lines.append(f"Content-Type: {content_type}")
+            lines.append(f"Content-Length: {len(body)}")
+        if etag is not None:
+            lines.append(f"ETag: {etag}")
+            lines.append("Cache-Control: no-cache")
+        if close:
+            lines.append("Connection: close")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if status != 304 and not head:
+            writer.write(body)
+        await writer.drain()
+
+    async def respond(self, method, target, headers):
+        '''
+        Builds the response to one request.
+
+        Returns
+        -------
+        status: int
+        content_type: string
+        body: bytes
+        etag: string or None
+        '''
+        if method not in ('GET', 'HEAD'):
+            return 405, 'text/plain; charset=utf-8', b"Only GET and HEAD are supported.\n", None
+        url = urlsplit(target)
+        if url.path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', METRICS.prometheus().encode(), None
+        route = SERVER_ROUTES.get(url.path)
+        if route is None:
+            return 404, 'text/plain; charset=utf-8', f"Unknown path: {url.path}\n".encode(), None
+        query = parse_qs(url.query)
+        loop = asyncio.get_running_loop()
+        version = await loop.run_in_executor(self.executor, get_data_version)
+        key = (url.path, tuple(sorted((name, tuple(values)) for name, values in query.items())), version)
+        response = self.cache.get(key)
+        if response is None:
+            future = self.pending.get(key)
+            if future is None:
+                future = loop.run_in_executor(self.executor, render_response, route, query)
+                self.pending[key] = future
+                try:
+                    response = await future
+                finally:
+                    del self.pending[key]
+                if response[0] == 200:
+                    self.cache.set(key, response)
+            else:
+                response = await asyncio.shield(future)
+        status, content_type, body, etag = response
+        if etag is not None and etag in headers.get('if-none-match', ''):
+            return 304, content_type, b'', etag
+        return status, content_type, body, etag
+
+def render_response(route, query):
+    '''
+    Runs one route of the local HTTP service on a worker thread.
+
+    Parameters
+    ----------
+    route: function
+        function that takes the parsed query string and returns the content
+        type and the body
+    query: dict
+        parsed query string
+
+    Returns
+    -------
+    status: int
+    content_type: string
+    body: bytes
+    etag: string or None
+        quoted hash of the body of successful responses
+    '''
+    try:
+        with METRICS.timer('server_render'):
+            content_type, body = route(query)
+    except HttpError as error:
+        return error.status, 'application/json', json.dumps({'error': error.message}).encode(), None
+    except Exception as error:
+        return 500, 'application/json', json.dumps({'error': f"{type(error).__name__}: {error}"}).encode(), None
+    body = body.encode('utf-8')
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return 200, content_type, body, etag
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, max_workers=SERVER_MAX_WORKERS):
+    '''
+    Runs the local HTTP service until it is interrupted.
+
+    Parameters
+    ----------
+    host: string
+        address to listen on
+    port: int
+        port to listen on
+    max_workers: int
+        number of threads doing the work
+
+    Returns
+    -------
+    none
+    '''
+    ensure_database()
+    try:
+        asyncio.run(PollutionServer(host, port, max_workers).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+def show_result(results, output=None):
+    '''
+    Shows a chart returned by one of the chart functions, or writes it to a
+    file. Strings returned instead of a chart are printed as errors.
+
+    Parameters
+    ----------
+    results: Plotly figure, pygal chart or string
+        the chart or the error message
+    output: string
+        HTML file to write the chart to, or None to open it in the browser
+
+    Returns
+    -------
+    exit_code: int
+        0 if a chart was shown, 1 otherwise
+    '''
+    if results is None:
+        print("Invalid country name.", file=sys.stderr)
+        return 1
+    if isinstance(results, str):
+        print(results, file=sys.stderr)
+        return 1
+    if output is None:
+        results.show()
+    else:
+        results.write_html(output)
+    return 0
+
+def parse_date(text, end_of_day=False):
+    '''
+    Converts a date such as 2021-01-31, or a unix time, to a unix time.
+    Dates are read as midnight UTC, or as the last second of the day when
+    end_of_day is True, so an end date includes that whole day.
+
+    Parameters
+    ----------
+    text: string
+        date or unix time
+    end_of_day: bool
+        True to read a date as the end of that day
+
+    Returns
+    -------
+    timestamp: int
+        unix time
+    '''
+    if text.strip().isdigit():
+        return int(text)
+    try:
+        date = datetime.datetime.strptime(text.strip(), '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date: {text}. Use YYYY-MM-DD.")
+    timestamp = int(date.replace(tzinfo=datetime.timezone.utc).timestamp())
+    if end_of_day:
+        timestamp += DAY_SECONDS - 1
+    return timestamp
+
+def parse_end_date(text):
+    '''
+    Converts an end date or a unix time to a unix time. A date is read as
+    the end of that day.
+
+    Parameters
+    ----------
+    text: string
+        date or unix time
+
+    Returns
+    -------
+    timestamp: int
+        unix time
+    '''
+    return parse_date(text, end_of_day=True)
+
+def add_date_arguments(parser):
+    '''
+    Adds the --start and --end arguments to a command.
+
+    Parameters
+    ----------
+    parser: argparse.ArgumentParser
+        parser of the command
+
+    Returns
+    -------
+    none
+    '''
+    parser.add_argument('--start', type=parse_date, help="start date such as 2020-11-27 (default 2020-11-27)")
+    parser.add_argument('--end', type=parse_end_date, help="last day such as 2021-03-27, included in the range (default 2021-03-27, or today if --start is given)")
+
+def ensure_database():
+    '''
+    Builds the database if it hasn't been built yet.
+
+    Parameters
+    ----------
+    none
+
+    Returns
+    -------
+    none
+    '''
+    if get_data_version() is None:
+        create_database()
+
+def main(argv=None):
+    '''
+    Runs the command line interface.
+
+    Parameters
+    ----------
+    argv: list
+        command line arguments, or None to use sys.argv
+
+    Returns
+    -------
+    exit_code: int
+        0 on success, 1 on error
+    '''
+    parser = argparse.ArgumentParser(description="Explore air pollution and CO2 emissions of cities and countries.")
+    parser.add_argument('--offline', action='store_true', help="build only from saved snapshots of the Wikipedia pages")
+    parser.add_argument('--metrics', choices=['json', 'prometheus'],
+            help="print stage timings and cache, HTTP and database counters to stderr after the command")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    city_parser = subparsers.add_parser('city', help="air pollution data for one city")
+    city_parser.add_argument('city', help="city name, state (optional), and country")
+    city_parser.add_argument('--json', action='store_true', help="print the data as JSON instead of showing a chart")
+    city_parser.add_argument('--stats', action='store_true', help="print median, 95th percentile, maximum and daily and weekly means as JSON")
+    city_parser.add_argument('--output', help="write the chart to this HTML file")
+
+    add_date_arguments(city_parser)
+
+    compare_parser = subparsers.add_parser('compare', help="rank cities by air pollution components")
+    compare_parser.add_argument('cities', nargs='*', help="city names")
+    compare_parser.add_argument('--file', help="file with one city name per line")
+    compare_parser.add_argument('--component', required=True, action='append', choices=[str(number) for number in range(1, 10)],
+            help="1 AQI, 2 CO, 3 NO, 4 NO2, 5 O3, 6 SO2, 7 PM 2.5, 8 PM 10, 9 NH3; repeat to compare several")
+    compare_parser.add_argument('--json', action='store_true', help="print the ranking as JSON instead of showing a chart")
+    compare_parser.add_argument('--output', help="write the chart to this HTML file")
+    add_date_arguments(compare_parser)
+
+    country_parser = subparsers.add_parser('country', help="air pollution or CO2 emissions for one country")
+    country_parser.add_argument('country', help="country name")
+    country_parser.add_argument('--type', choices=['emissions', 'air-pollution'], default='emissions')
+    country_parser.add_argument('--years', help="range of years such as 1990-2017")
+    country_parser.add_argument('--output', help="write the chart to this HTML file")
+
+    map_parser = subparsers.add_parser('map', help="air pollution or CO2 emissions world map")
+    map_parser.add_argument('--type', choices=['emissions', 'air-pollution'], default='emissions')
+    map_parser.add_argument('--year', help="year such as 2005 or range such as 1990-2017")
+    map_parser.add_argument('--all', action='store_true', help="render every map type and year to files")
+    map_parser.add_argument('--output', help="write the map to this file; .html and .htm files get an HTML page")
+    map_parser.add_argument('--output-dir', default=MAPS_DIRECTORY, help="directory for --all")
+    map_parser.add_argument('--format', choices=['svg', 'html'], default='svg', help="file format for --all and --output")
+
+    build_parser = subparsers.add_parser('build-db', help="build or update the database")
+    build_parser.add_argument('--force', action='store_true', help="rebuild even if the sources haven't changed")
+
+    rank_parser = subparsers.add_parser('rank', help="top countries, largest changes or yearly totals as JSON")
+    rank_parser.add_argument('--type', choices=['emissions', 'air-pollution'], default='emissions')
+    rank_parser.add_argument('--indicator', help="indicator code such as CO2.PC or SP.POP.TOTL, instead of --type")
+    rank_parser.add_argument('--year', type=int, help="rank the countries of this year")
+    rank_parser.add_argument('--top', type=int, default=20, help="number of countries (default 20)")
+    rank_parser.add_argument('--lowest', action='store_true', help="countries with the lowest values instead of the highest")
+    rank_parser.add_argument('--change', choices=['fell', 'rose'],
+            help=f"countries whose values fell or rose the most from {CHANGE_YEARS[0]} to {CHANGE_YEARS[1]}")
+    rank_parser.add_argument('--percent', action='store_true', help="order changes by percent instead of absolute change")
+    rank_parser.add_argument('--totals', nargs='?', const=WORLD_REGION, choices=(WORLD_REGION,) + REGIONS,
+            help="yearly totals and means of the world or a region")
+
+    serve_parser = subparsers.add_parser('serve', help="run a local HTTP service with JSON data and charts")
+    serve_parser.add_argument('--host', default=SERVER_HOST)
+    serve_parser.add_argument('--port', type=int, default=SERVER_PORT)
+    serve_parser.add_argument('--workers', type=int, default=SERVER_MAX_WORKERS, help="number of threads doing the work")
+
+    args = parser.parse_args(argv)
+    if args.offline:
+        set_offline(True)
+    if args.metrics:
+        METRICS.enabled = True
+    try:
+        with METRICS.timer(f"command_{args.command}"):
+            return run_command(args)
+    except MissingSnapshotError as error:
+        print(error, file=sys.stderr)
+        return 1
+    finally:
+        if args.metrics == 'json':
+            print(json.dumps(METRICS.summary(), indent=2), file=sys.stderr)
+        elif args.metrics == 'prometheus':
+            print(METRICS.prometheus(), end='', file=sys.stderr)
+
+def run_command(args):
+    '''
+    Runs one command of the command line interface.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        parsed command line arguments
+
+    Returns
+    -------
+    exit_code: int
+        0 on success, 1 on error
+    '''
+    if args.command == 'city':
+        if args.stats:
+            stats = get_pollution_stats(args.city, args.start, args.end)
+            if isinstance(stats, str):
+                print(stats, file=sys.stderr)
+                return 1
+            print(json.dumps(stats))
+            return 0
+        if args.json:
+            city_data = get_pollution_data(args.city, args.start, args.end)
+            if isinstance(city_data, str):
+                print(city_data, file=sys.stderr)
+                return 1
+            print(json.dumps(city_data))
+            return 0
+        return show_result(create_city_pollution_bar_chart(args.city, start=args.start, end=args.end), args.output)
+    elif args.command == 'compare':
+        cities = list(args.cities)
+        if args.file is not None:
+            with open(args.file, encoding='utf-8') as file:
+                cities.extend(line.strip() for line in file if line.strip())
+        if len(cities) < 2:
+            print("Enter at least two cities to compare.", file=sys.stderr)
+            return 1
+        comparison = compare_cities(cities, args.component, args.start, args.end)
+        for city, error in comparison['errors'].items():
+            print(error, file=sys.stderr)
+        if args.json:
+            print(json.dumps(comparison))
+            return 0 if comparison['ranking'] else 1
+        return show_result(create_city_comparison_chart(comparison), args.output)
+    elif args.command == 'country':
+        ensure_database()
+        graph_type = '1' if args.type == 'emissions' else '2'
+        if args.years is None:
+            return show_result(generate_line_graph(args.country, graph_type), args.output)
+        years = parse_year_range(args.years)
+        if years is None:
+            print(f"Invalid range of years: {args.years}", file=sys.stderr)
+            return 1
+        return show_result(generate_line_graph(args.country, graph_type, years[0], years[1]), args.output)
+    elif args.command == 'map':
+        ensure_database()
+        map_type = 1 if args.type == 'emissions' else 2
+        if args.all:
+            filenames = render_world_maps(map_types=(1, 2), output_dir=args.output_dir, file_format=args.format)
+            for key in sorted(filenames):
+                print(filenames[key])
+            return 0
+        years = parse_year_range(args.year or '')
+        if years is None:
+            print("Enter a year such as 2005 or a range such as 1990-2017 with --year.", file=sys.stderr)
+            return 1
+        if args.output is not None:
+            file_format = 'html' if args.output.lower().endswith(('.html', '.htm')) else args.format
+            if render_world_map_file(map_type, years, args.output, file_format) is None:
+                print(f"No data for {args.year}", file=sys.stderr)
+                return 1
+            return 0
+        results = generate_world_map(map_type, years)
+        if isinstance(results, str):
+            print(results, file=sys.stderr)
+            return 1
+        return 0
+    elif args.command == 'build-db':
+        if create_database(force=args.force):
+            print("Database built.")
+        else:
+            print("Database is up to date.")
+        return 0
+    elif args.command == 'rank':
+        ensure_database()
+        map_type = 1 if args.type == 'emissions' else 2
+        if args.indicator is not None:
+            map_type = args.indicator
+        if args.totals is not None:
+            print(json.dumps(get_totals(map_type, args.totals)))
+        elif args.change is not None:
+            print(json.dumps(get_largest_changes(map_type, args.top, args.change == 'fell', args.percent)))
+        elif args.year is not None:
+            print(json.dumps(get_top_countries(map_type, args.year, args.top, args.lowest)))
         else:
-            print("\nInvalid selection")
+            print("Enter --year, --change or --totals.", file=sys.stderr)
+            return 1
+        return 0
+    elif args.command == 'serve':
+        serve(args.host, args.port, args.workers)
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(main())